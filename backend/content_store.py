@@ -0,0 +1,180 @@
+import hashlib
+import logging
+from datetime import datetime, timezone
+from typing import Dict, Iterable, Optional, Set
+
+from sqlalchemy import func, or_
+from sqlalchemy.orm import Session
+
+from models import ContentBlob, SearchResult, shard_scan
+
+logger = logging.getLogger(__name__)
+
+MIGRATION_BATCH_SIZE = 500
+
+
+def content_hash(body: str) -> str:
+    return hashlib.sha256(body.encode("utf-8")).hexdigest()
+
+
+def _insert_ignoring_duplicates(db: Session):
+    dialect = db.get_bind(ContentBlob).dialect.name
+    if dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+        return insert(ContentBlob.__table__).on_conflict_do_nothing(index_elements=["hash"])
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+        return insert(ContentBlob.__table__).on_conflict_do_nothing(index_elements=["hash"])
+    if dialect in ("mysql", "mariadb"):
+        return ContentBlob.__table__.insert().prefix_with("IGNORE")
+    return ContentBlob.__table__.insert()
+
+
+class ContentInterner:
+    """Collects text bodies for one transaction and stores each distinct body once."""
+
+    def __init__(self, db: Session):
+        self.db = db
+        self._pending: Dict[str, str] = {}
+
+    def add(self, body: Optional[str]) -> Optional[str]:
+        if body is None:
+            return None
+        digest = content_hash(body)
+        self._pending.setdefault(digest, body)
+        return digest
+
+    def flush(self) -> int:
+        """Insert blobs not already stored; returns the number of new blobs."""
+        if not self._pending:
+            return 0
+        hashes = list(self._pending)
+        existing = set()
+        # Stay well below SQLite's bound-parameter limit
+        for start in range(0, len(hashes), MIGRATION_BATCH_SIZE):
+            chunk = hashes[start:start + MIGRATION_BATCH_SIZE]
+            existing.update(
+                row[0] for row in self.db.query(ContentBlob.hash).filter(ContentBlob.hash.in_(chunk))
+            )
+        now = datetime.now(timezone.utc)
+        new_blobs = [
+            {"hash": digest, "body": body, "size": len(body.encode("utf-8")), "created_at": now}
+            for digest, body in self._pending.items()
+            if digest not in existing
+        ]
+        if new_blobs:
+            # Another writer may store the same body between the check above and this
+            # insert; the pre-check only saves resending bodies that are already stored
+            self.db.execute(_insert_ignoring_duplicates(self.db), new_blobs)
+            self.db.flush()
+        self._pending.clear()
+        return len(new_blobs)
+
+
+def migrate_inline_content(db: Session) -> dict:
+    """Move pre-deduplication inline snippet/llm_content text into content_blobs."""
+    migrated_rows = 0
+    while True:
+        rows = (
+            db.query(SearchResult)
+            .filter(
+                or_(
+                    SearchResult.snippet_inline.isnot(None),
+                    SearchResult.llm_content_inline.isnot(None),
+                )
+            )
+            .limit(MIGRATION_BATCH_SIZE)
+            .all()
+        )
+        if not rows:
+            break
+        interner = ContentInterner(db)
+        for row in rows:
+            if row.snippet_inline is not None:
+                row.snippet_hash = interner.add(row.snippet_inline)
+                row.snippet_inline = None
+            if row.llm_content_inline is not None:
+                row.llm_content_hash = interner.add(row.llm_content_inline)
+                row.llm_content_inline = None
+        interner.flush()
+        db.commit()
+        migrated_rows += len(rows)
+
+    report = storage_report(db)
+    report["migrated_rows"] = migrated_rows
+    return report
+
+
+def session_content_hashes(db: Session, game_session_id: int) -> Set[str]:
+    """Blob hashes referenced by one session; collect them before deleting it."""
+    rows = db.query(SearchResult.snippet_hash, SearchResult.llm_content_hash).filter(
+        SearchResult.game_session_id == game_session_id
+    )
+    return {digest for row in rows for digest in row if digest}
+
+
+def prune_orphan_content(db: Session, candidates: Optional[Iterable[str]] = None) -> int:
+    """Delete blobs no longer referenced by any search result.
+
+    With `candidates`, only those hashes are checked, using the hash indexes, so the
+    cost follows the deleted session rather than the whole database.
+    """
+    if candidates is None:
+        referenced = db.query(SearchResult.snippet_hash).filter(SearchResult.snippet_hash.isnot(None)).union(
+            db.query(SearchResult.llm_content_hash).filter(SearchResult.llm_content_hash.isnot(None))
+        )
+        return (
+            db.query(ContentBlob)
+            .filter(ContentBlob.hash.notin_(referenced))
+            .delete(synchronize_session=False)
+        )
+
+    candidates = list(set(candidates))
+    deleted = 0
+    for start in range(0, len(candidates), MIGRATION_BATCH_SIZE):
+        chunk = candidates[start:start + MIGRATION_BATCH_SIZE]
+        still_referenced = set()
+        for column in (SearchResult.snippet_hash, SearchResult.llm_content_hash):
+            still_referenced.update(row[0] for row in db.query(column).filter(column.in_(chunk)).distinct())
+        orphans = [digest for digest in chunk if digest not in still_referenced]
+        if orphans:
+            deleted += (
+                db.query(ContentBlob)
+                .filter(ContentBlob.hash.in_(orphans))
+                .delete(synchronize_session=False)
+            )
+    return deleted
+
+
+def storage_report(db: Session) -> dict:
+    stored_bytes = blob_count = logical_bytes = 0
+    for _ in shard_scan(db):
+        stored_bytes += db.query(func.coalesce(func.sum(ContentBlob.size), 0)).scalar()
+        blob_count += db.query(func.count(ContentBlob.hash)).scalar()
+        # Bytes the same references would take if every row stored its own copy
+        for column in (SearchResult.snippet_hash, SearchResult.llm_content_hash):
+            logical_bytes += (
+                db.query(func.coalesce(func.sum(ContentBlob.size), 0))
+                .select_from(SearchResult)
+                .join(ContentBlob, ContentBlob.hash == column)
+                .scalar()
+            )
+    return {
+        "blob_count": blob_count,
+        "stored_bytes": stored_bytes,
+        "logical_bytes": logical_bytes,
+        "saved_bytes": logical_bytes - stored_bytes,
+    }
+
+
+if __name__ == "__main__":
+    from models import create_tables, shard_session_factories
+
+    logging.basicConfig(level=logging.INFO)
+    create_tables()
+    for shard_session in shard_session_factories:
+        session = shard_session()
+        try:
+            print(migrate_inline_content(session))
+        finally:
+            session.close()
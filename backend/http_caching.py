@@ -0,0 +1,163 @@
+import gzip
+import hashlib
+import logging
+import os
+import re
+import sys
+from mimetypes import guess_type
+from typing import Dict, Optional, Tuple
+
+from starlette.datastructures import Headers, QueryParams
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+
+try:
+    import brotli  # Optional: only needed to produce .br files
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+LONG_LIVED_CACHE = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE = "no-cache"
+
+COMPRESSIBLE_EXTENSIONS = (".js", ".css", ".html", ".svg", ".json", ".txt")
+# Preferred order when the client accepts several encodings
+PRECOMPRESSED_ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+_STATIC_REFERENCE = re.compile(r"""(["'])/static/([^"'?#]+)(?:\?v=[^"'#]*)?\1""")
+_fingerprints: Dict[str, Tuple[float, int, str]] = {}
+
+
+def weak_etag(*parts) -> str:
+    digest = hashlib.sha1(":".join(str(part) for part in parts).encode("utf-8")).hexdigest()[:20]
+    return f'W/"{digest}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # Weak comparison: W/"x" and "x" match
+    wanted = etag[2:] if etag.startswith("W/") else etag
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == wanted:
+            return True
+    return False
+
+
+def file_fingerprint(path: str) -> str:
+    """Short content hash of a file, cached until its mtime or size changes."""
+    stat = os.stat(path)
+    cached = _fingerprints.get(path)
+    if cached and cached[0] == stat.st_mtime and cached[1] == stat.st_size:
+        return cached[2]
+    with open(path, "rb") as handle:
+        fingerprint = hashlib.sha256(handle.read()).hexdigest()[:12]
+    _fingerprints[path] = (stat.st_mtime, stat.st_size, fingerprint)
+    return fingerprint
+
+
+def fingerprint_static_references(html: str, static_root: str) -> str:
+    """Point every /static/ reference at ?v=<content hash> so it can be cached forever."""
+    def replace(match):
+        quote, relative_path = match.group(1), match.group(2)
+        full_path = os.path.join(static_root, relative_path)
+        if not os.path.isfile(full_path):
+            return match.group(0)
+        return f"{quote}/static/{relative_path}?v={file_fingerprint(full_path)}{quote}"
+
+    return _STATIC_REFERENCE.sub(replace, html)
+
+
+def _accepted_encodings(headers: Headers) -> set:
+    accepted = set()
+    for token in headers.get("accept-encoding", "").split(","):
+        name, _, params = token.strip().partition(";")
+        if params.replace(" ", "") in ("q=0", "q=0.0"):
+            continue
+        if name:
+            accepted.add(name.strip().lower())
+    return accepted
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    """StaticFiles that serves .br/.gz siblings when accepted and sets cache headers.
+
+    Requests whose ?v= matches the file's content hash are cacheable for a year;
+    everything else must revalidate against the ETag.
+    """
+
+    def file_response(self, full_path, stat_result, scope, status_code=200) -> Response:
+        request_headers = Headers(scope=scope)
+        full_path = str(full_path)
+        headers = {
+            "Vary": "Accept-Encoding",
+            "Cache-Control": self._cache_control(full_path, scope),
+        }
+        media_type = guess_type(full_path)[0] or "text/plain"
+
+        if full_path.endswith(COMPRESSIBLE_EXTENSIONS):
+            accepted = _accepted_encodings(request_headers)
+            for encoding, suffix in PRECOMPRESSED_ENCODINGS:
+                if encoding not in accepted:
+                    continue
+                variant_path = full_path + suffix
+                try:
+                    variant_stat = os.stat(variant_path)
+                except OSError:
+                    continue
+                # Ignore variants left behind by an older version of the file
+                if variant_stat.st_mtime < stat_result.st_mtime:
+                    continue
+                full_path, stat_result = variant_path, variant_stat
+                headers["Content-Encoding"] = encoding
+                break
+
+        response = FileResponse(
+            full_path, status_code=status_code, stat_result=stat_result, media_type=media_type, headers=headers
+        )
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
+
+    def _cache_control(self, full_path: str, scope) -> str:
+        version = QueryParams(scope.get("query_string", b"")).get("v")
+        if version and version == file_fingerprint(full_path):
+            return LONG_LIVED_CACHE
+        return REVALIDATE_CACHE
+
+
+def precompress_directory(root: str) -> int:
+    """Write .gz (and .br when brotli is installed) next to each compressible file."""
+    written = 0
+    for directory, _, filenames in os.walk(root):
+        for filename in filenames:
+            if not filename.endswith(COMPRESSIBLE_EXTENSIONS):
+                continue
+            path = os.path.join(directory, filename)
+            with open(path, "rb") as handle:
+                data = handle.read()
+            variants = [(".gz", gzip.compress(data, compresslevel=9, mtime=0))]
+            if brotli is not None:
+                variants.append((".br", brotli.compress(data, quality=11)))
+            for suffix, compressed in variants:
+                # Not worth serving if compression does not help
+                if len(compressed) >= len(data):
+                    continue
+                with open(path + suffix, "wb") as handle:
+                    handle.write(compressed)
+                written += 1
+    return written
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    target = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(__file__), "..", "frontend")
+    if brotli is None:
+        logger.info("brotli is not installed; writing gzip variants only")
+    logger.info("Wrote %d precompressed files under %s", precompress_directory(target), target)
@@ -1,16 +1,34 @@
-from fastapi import FastAPI, Depends, HTTPException
-from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, Depends, HTTPException, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from pydantic import BaseModel
 from perplexity import Perplexity
 from dotenv import load_dotenv
+from sqlalchemy import func
 from sqlalchemy.orm import Session
+import asyncio
 import logging
 import os
 import json
 from datetime import datetime, timezone
-from typing import Optional
+from typing import List, Optional
+from pydantic import ValidationError
+from spaced_repetition import next_review
+from upstream_replay import UpstreamGateway
+from profiling import (
+    ProfilingMiddleware, collapsed_stacks, get_report, install_sql_tracing, profiling_enabled, run_in_threadpool,
+    token_matches, track_thread
+)
+from http_caching import (
+    REVALIDATE_CACHE, PrecompressedStaticFiles, etag_matches, fingerprint_static_references, weak_etag
+)
+from quiz_engine import QUIZ_MODE, QUIZ_MODES, build_quiz, is_full_quiz
+from prefetch import CHILD_QUERY_TEMPLATE, PREFETCH_ENABLED, ExpansionPrefetcher
+from prompt_budget import (
+    CHARS_PER_TOKEN, MAX_PROMPT_CHUNKS, PROMPT_TOKEN_BUDGET, Timer, chunk_items, chunk_text,
+    content_budget, estimate_tokens, metrics, split_count
+)
 
 load_dotenv()
 app = FastAPI()
@@ -22,16 +40,31 @@ def _db_unavailable_error() -> HTTPException:
 
 DB_AVAILABLE = False
 SessionLocal = None  # Will be set if database initializes successfully
+retention_scheduler = None
 
 try:
     from models import (
-        create_tables, get_db, GameSession, SearchResult, Branch, 
-        Leaf, Flashcard, Fruit, Flower, SessionLocal as ModelSessionLocal
+        create_tables, get_db, GameSession, Branch, Flashcard, ArchivedSession,
+        SessionLocal as ModelSessionLocal, engines, shard_scan, shard_session_factories
     )
+    from content_store import migrate_inline_content, prune_orphan_content, session_content_hashes, storage_report
+    from session_transfer import MAX_IMPORT_BYTES, SessionImporter, export_sessions_ndjson, serialize_game_session
+    from retention import RetentionScheduler, load_archived_session
+    from save_stream import InvalidSavePayload, PayloadTooLarge, StreamingSave, ingest_save, spool_save_body
 
     create_tables()
+    for _shard_index, _shard_session in enumerate(shard_session_factories):
+        _migration_db = _shard_session()
+        try:
+            logger.info("Search result content migration (shard %d): %s", _shard_index, migrate_inline_content(_migration_db))
+        finally:
+            _migration_db.close()
     DB_AVAILABLE = True
     SessionLocal = ModelSessionLocal
+    if profiling_enabled():
+        for _engine in engines:
+            install_sql_tracing(_engine)
+    retention_scheduler = RetentionScheduler(SessionLocal, engines)
     logger.info("Database initialized successfully.")
 except Exception as exc:
     logger.error("Database initialization failed: %s", exc)
@@ -39,6 +72,9 @@ except Exception as exc:
     def get_db():  # type: ignore
         raise _db_unavailable_error()
 
+# Recording/replay needs the database; without it every call goes straight upstream
+upstream = UpstreamGateway(SessionLocal if DB_AVAILABLE else None)
+
 
 # Add CORS middleware
 app.add_middleware(
@@ -47,18 +83,33 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],  # Allows all methods
     allow_headers=["*"],  # Allows all headers
+    expose_headers=["ETag", "X-Profile-Report"],
 )
 
+# Compress API responses; precompressed static files already carry Content-Encoding
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+
+# Per-request profiling (X-Profile: <PROFILE_TOKEN>); not installed at all without a token
+if profiling_enabled():
+    app.add_middleware(ProfilingMiddleware)
+
 # Mount frontend
 frontend_path = os.path.join(os.path.dirname(__file__), "..", "frontend")
-app.mount("/static", StaticFiles(directory=frontend_path), name="static")
+app.mount("/static", PrecompressedStaticFiles(directory=frontend_path), name="static")
 
 @app.get("/")
-async def serve_game():
-    return FileResponse(os.path.join(os.path.dirname(__file__), "..", "frontend", "index.html"))
+async def serve_game(request: Request):
+    with open(os.path.join(frontend_path, "index.html"), encoding="utf-8") as index_file:
+        html = fingerprint_static_references(index_file.read(), frontend_path)
+    etag = weak_etag(html)
+    headers = {"ETag": etag, "Cache-Control": REVALIDATE_CACHE}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return HTMLResponse(html, headers=headers)
 
 class SearchRequest(BaseModel):
     query: str
+    prefetch: Optional[bool] = None  # Overrides SPECULATIVE_PREFETCH for this request
 
 class WebSearchRequest(BaseModel):
     query: str
@@ -88,13 +139,30 @@ class DeleteGameStateRequest(BaseModel):
     session_id: int
 
 class GenerateQuizRequest(BaseModel):
-    flashcards: list
+    flashcards: list = []
+    session_id: Optional[int] = None  # Stored cards of this session join the pool (and the deck if none are sent)
+    mode: Optional[str] = None  # "local", "llm" or "auto"; defaults to QUIZ_MODE
+
+class BatchOperation(BaseModel):
+    op: str  # Endpoint name without the /api/ prefix, e.g. "web-search"
+    id: Optional[str] = None  # Defaults to the operation's index
+    params: dict = {}
+    depends_on: list = []  # Ids of earlier operations that must succeed first
+
+class BatchRequest(BaseModel):
+    operations: List[BatchOperation]
+
+class ReviewFlashcardRequest(BaseModel):
+    flashcard_id: int
+    grade: int  # SM-2 recall quality, 0 (blackout) to 5 (perfect)
 
 @app.post("/api/search")
-async def search(request: SearchRequest):
+@track_thread
+def search(request: SearchRequest):
+    return _search(request)
+
+def _search(request: SearchRequest, client: Optional[Perplexity] = None) -> dict:
     try:
-        client = Perplexity()
-        
         # Define the JSON schema for structured output
         schema = {
             "type": "object",
@@ -118,19 +186,13 @@ async def search(request: SearchRequest):
         }
         
         # Use structured outputs to get exactly 5 areas with descriptions
-        completion = client.chat.completions.create(
-            model="sonar-pro",
-            messages=[
-                {"role": "user", "content": f"What are the primary 5 areas in {request.query}? Please provide exactly 5 distinct areas, each with a brief description and a relevant search query for further research. Return the data as a JSON object with the following structure: areas array with 5 objects, each containing name, description, and search_query fields."}
-            ],
-            response_format={
-                "type": "json_schema",
-                "json_schema": {"schema": schema}
-            }
+        response_content = _chat_completion(
+            f"What are the primary 5 areas in {request.query}? Please provide exactly 5 distinct areas, each with a brief description and a relevant search query for further research. Return the data as a JSON object with the following structure: areas array with 5 objects, each containing name, description, and search_query fields.",
+            schema,
+            client
         )
         
         # Parse the structured JSON response
-        response_content = completion.choices[0].message.content
         try:
             structured_data = json.loads(response_content)
         except json.JSONDecodeError as e:
@@ -161,26 +223,46 @@ async def search(request: SearchRequest):
                     "llm_content": response_content
                 })
         
+        # Warm the child expansions the frontend is about to request
+        prefetch = request.prefetch if request.prefetch is not None else PREFETCH_ENABLED
+        if prefetch:
+            for result in results:
+                expansion_prefetcher.schedule(CHILD_QUERY_TEMPLATE.format(topic=result["title"], query=request.query))
+        
         return {"query": request.query, "results": results, "structured_data": structured_data}
     except Exception as e:
         return {"error": str(e), "query": request.query}
 
-@app.post("/api/web-search")
-def web_search(request: WebSearchRequest):
-    try:
-        client = Perplexity()
+def _chat_completion(prompt: str, schema: dict, client: Optional[Perplexity] = None) -> str:
+    request = {
+        "model": "sonar-pro",
+        "messages": [
+            {"role": "user", "content": prompt}
+        ],
+        "response_format": {
+            "type": "json_schema",
+            "json_schema": {"schema": schema}
+        }
+    }
+
+    def live() -> str:
+        completion = (client or Perplexity()).chat.completions.create(**request)
+        return completion.choices[0].message.content
+
+    return upstream.call("chat", request, live)
 
-        # Construct query with negative prompts if provided
-        query = request.query
-        if request.negative_prompts:
-            # Add negative prompts to exclude existing results
-            negative_terms = ", ".join([f'"{prompt}"' for prompt in request.negative_prompts])
-            query = f"{request.query} -{negative_terms}"
+def _run_web_search(query: str, count: int, negative_prompts: list, client: Optional[Perplexity] = None) -> list:
+    # Construct query with negative prompts if provided
+    if negative_prompts:
+        # Add negative prompts to exclude existing results
+        negative_terms = ", ".join([f'"{prompt}"' for prompt in negative_prompts])
+        query = f"{query} -{negative_terms}"
 
+    def live() -> list:
         # Use basic search that works (images not supported in this SDK version)
-        search = client.search.create(
+        search = (client or Perplexity()).search.create(
             query=query,
-            max_results=request.count,
+            max_results=count,
             max_tokens_per_page=1024
         )
         
@@ -196,285 +278,284 @@ def web_search(request: WebSearchRequest):
                 "llm_content": result.snippet if hasattr(result, 'snippet') else "No description available",
                 "images": []  # Images not supported in this SDK version
             })
-        
+        return results
+
+    return upstream.call("search", {"query": query, "max_results": count, "max_tokens_per_page": 1024}, live)
+
+expansion_prefetcher = ExpansionPrefetcher(_run_web_search)
+
+@app.post("/api/web-search")
+@track_thread
+def web_search(request: WebSearchRequest):
+    try:
+        results = expansion_prefetcher.lookup(request.query, request.count, request.negative_prompts)
+        if results is None:
+            results = _run_web_search(request.query, request.count, request.negative_prompts)
         return {"query": request.query, "results": results}
     except Exception as e:
         return {"error": str(e), "query": request.query}
 
-@app.post("/api/save-game-state")
-async def save_game_state(request: SaveGameStateRequest, db: Session = Depends(get_db)):
-    if not DB_AVAILABLE:
-        raise _db_unavailable_error()
-    try:
-        # Create new game session
-        game_session = GameSession(
-            original_search_query=request.original_search_query,
-            camera_offset_x=request.camera_offset.get("x", 0.0) if request.camera_offset else 0.0,
-            camera_offset_y=request.camera_offset.get("y", 0.0) if request.camera_offset else 0.0,
-            created_at=datetime.now(timezone.utc),
-            updated_at=datetime.now(timezone.utc)
+@app.get("/api/profiles/{report_id}")
+async def get_profile_report(report_id: str, request: Request, format: str = "json", token: Optional[str] = None):
+    if not token_matches(request.headers.get("x-profile") or token):
+        raise HTTPException(status_code=404, detail="Not found")
+    report = get_report(report_id)
+    if report is None:
+        raise HTTPException(status_code=404, detail="Profile report not found or expired")
+    if format == "collapsed":
+        return PlainTextResponse(
+            collapsed_stacks(report),
+            headers={"Content-Disposition": f'attachment; filename="profile-{report_id}.folded"'}
         )
-        db.add(game_session)
-        db.flush()  # Get the ID
-        
-        # Save search results
-        search_result_objects = []
-        for result in request.search_results:
-            search_result = SearchResult(
-                game_session_id=game_session.id,
-                title=result.get("title", ""),
-                url=result.get("url", ""),
-                snippet=result.get("snippet", ""),
-                llm_content=result.get("llm_content", ""),
-                search_query=result.get("search_query", ""),
-                created_at=datetime.now(timezone.utc)
-            )
-            db.add(search_result)
-            search_result_objects.append(search_result)
-        
-        db.flush()  # Get search result IDs
-        
-        # Save branches with hierarchy tracking
-        branch_objects = []
-        for i, branch_data in enumerate(request.branches):
-            search_result_id = None
-            
-            # Check if branch has its own search result data
-            if branch_data.get("searchResult"):
-                # Create a new search result for this branch
-                branch_search_result = SearchResult(
-                    game_session_id=game_session.id,
-                    title=branch_data["searchResult"].get("title", ""),
-                    url=branch_data["searchResult"].get("url", ""),
-                    snippet=branch_data["searchResult"].get("snippet", ""),
-                    llm_content=branch_data["searchResult"].get("llm_content", ""),
-                    search_query=branch_data["searchResult"].get("search_query", ""),
-                    created_at=datetime.now(timezone.utc)
-                )
-                db.add(branch_search_result)
-                db.flush()  # Get the ID
-                search_result_id = branch_search_result.id
-            elif i < len(search_result_objects):
-                # Fallback to index-based matching for initial branches
-                search_result_id = search_result_objects[i].id
-            else:
-                search_result_id = None
-            
-            branch = Branch(
-                game_session_id=game_session.id,
-                search_result_id=search_result_id,
-                parent_branch_id=branch_data.get("parentBranchId"),  # Track parent
-                start_x=branch_data.get("start", {}).get("x", 0),
-                start_y=branch_data.get("start", {}).get("y", 0),
-                end_x=branch_data.get("end", {}).get("x", 0),
-                end_y=branch_data.get("end", {}).get("y", 0),
-                length=branch_data.get("length", 0),
-                max_length=branch_data.get("maxLength", 0),
-                angle=branch_data.get("angle", 0),
-                thickness=branch_data.get("thickness", 1),
-                generation=branch_data.get("generation", 0),
-                is_growing=branch_data.get("isGrowing", False),
-                growth_speed=branch_data.get("growthSpeed", 1.0),
-                node_type=branch_data.get("nodeType", "branch"),
-                created_at=datetime.now(timezone.utc)
-            )
-            db.add(branch)
-            branch_objects.append(branch)
-        
-        db.flush()  # Get branch IDs
-        
-        # Save leaves
-        for leaf_data in request.leaves:
-            leaf = Leaf(
-                game_session_id=game_session.id,
-                branch_id=leaf_data.get("branchId"),  # Can be None now
-                x=leaf_data.get("x", 0),
-                y=leaf_data.get("y", 0),
-                size=leaf_data.get("size", 1.0),
-                created_at=datetime.now(timezone.utc)
-            )
-            db.add(leaf)
-        
-        # Save fruits
-        for fruit_data in request.fruits:
-            fruit = Fruit(
-                game_session_id=game_session.id,
-                x=fruit_data.get("x", 0),
-                y=fruit_data.get("y", 0),
-                type=fruit_data.get("type", "apple"),
-                size=fruit_data.get("size", 1.0),
-                created_at=datetime.now(timezone.utc)
-            )
-            db.add(fruit)
-        
-        # Save flowers
-        for flower_data in request.flowers:
-            flower = Flower(
-                game_session_id=game_session.id,
-                x=flower_data.get("x", 0),
-                y=flower_data.get("y", 0),
-                type=flower_data.get("type", "🌸"),
-                size=flower_data.get("size", 1.0),
-                created_at=datetime.now(timezone.utc)
-            )
-            db.add(flower)
-        
-        # Save flashcards
-        for flashcard_data in request.flashcards:
-            # Extract node position if available
-            node_position = flashcard_data.get("node_position", {})
-            flashcard = Flashcard(
-                game_session_id=game_session.id,
-                branch_id=flashcard_data.get("branch_id"),
-                front=flashcard_data.get("front", ""),
-                back=flashcard_data.get("back", ""),
-                difficulty=flashcard_data.get("difficulty", "medium"),
-                category=flashcard_data.get("category", ""),
-                node_position_x=node_position.get("x"),
-                node_position_y=node_position.get("y"),
-                created_at=datetime.now(timezone.utc)
-            )
-            db.add(flashcard)
-        
+    return JSONResponse(report, headers={"Content-Disposition": f'attachment; filename="profile-{report_id}.json"'})
+
+@app.get("/api/upstream-status")
+async def get_upstream_status():
+    return {"success": True, "upstream": upstream.status()}
+
+@app.get("/api/prefetch-metrics")
+async def get_prefetch_metrics():
+    return {"success": True, "enabled": PREFETCH_ENABLED, "metrics": expansion_prefetcher.snapshot()}
+
+def _save_game_state(request: SaveGameStateRequest, db: Session) -> dict:
+    """Save an already-parsed state (batch and WebSocket saves) through the same batched writer."""
+    try:
+        save = StreamingSave(db)
+        save.add("value", "original_search_query", request.original_search_query)
+        save.add("value", "camera_offset", request.camera_offset)
+        for key in StreamingSave.ARRAY_KEYS:
+            save.add("array", key, None)
+            for item in getattr(request, key):
+                save.add("item", key, item)
+        session_id = save.finish()
         db.commit()
-        
         return {
             "success": True,
-            "session_id": game_session.id,
+            "session_id": session_id,
             "message": "Game state saved successfully"
         }
-        
     except Exception as e:
         db.rollback()
         return {"error": str(e), "success": False}
 
-@app.post("/api/load-game-state")
-async def load_game_state(request: LoadGameStateRequest, db: Session = Depends(get_db)):
+def _save_spooled_game_state(body, db: Session) -> dict:
+    try:
+        save = ingest_save(db, body)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return {
+        "success": True,
+        "session_id": save.game_session_id,
+        "message": "Game state saved successfully"
+    }
+
+@app.post("/api/save-game-state")
+async def save_game_state(http_request: Request, db: Session = Depends(get_db)):
+    # Body has the SaveGameStateRequest shape. It is spooled first, then parsed and written
+    # in batches in the threadpool, so memory stays bounded by SAVE_BATCH_SIZE rather than
+    # the size of the tree and no transaction stays open while the upload arrives
+    if not DB_AVAILABLE:
+        raise _db_unavailable_error()
+    content_length = http_request.headers.get("content-length")
+    try:
+        body = await spool_save_body(
+            http_request.stream(), int(content_length) if content_length and content_length.isdigit() else None
+        )
+    except PayloadTooLarge as e:
+        return JSONResponse(status_code=413, content={"error": str(e), "success": False})
+    try:
+        return await run_in_threadpool(_save_spooled_game_state, body, db)
+    except InvalidSavePayload as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except Exception as e:
+        return {"error": str(e), "success": False}
+    finally:
+        body.close()
+
+def _game_state_etag(db: Session, game_session) -> str:
+    # Flashcard reviews and additions do not touch the session row, so fold them in
+    flashcard_count, last_reviewed = db.query(
+        func.count(Flashcard.id), func.max(Flashcard.last_reviewed)
+    ).filter(Flashcard.game_session_id == game_session.id).one()
+    return weak_etag(game_session.id, game_session.updated_at.isoformat(), flashcard_count, last_reviewed)
+
+def _load_archived_game_state(session_id: int, http_request: Request, response: Response, db: Session):
+    archived_at = db.query(ArchivedSession.archived_at).filter(ArchivedSession.id == session_id).scalar()
+    if archived_at is None:
+        raise HTTPException(status_code=404, detail="Game session not found")
+    # Archived sessions are immutable, so the archive time identifies the content
+    etag = weak_etag("archived", session_id, archived_at.isoformat())
+    if etag_matches(http_request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": REVALIDATE_CACHE})
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = REVALIDATE_CACHE
+    return {
+        "success": True,
+        "archived": True,
+        "game_state": load_archived_session(db, session_id)
+    }
+
+def _load_game_state(session_id: int, http_request: Request, response: Response, db: Session):
     if not DB_AVAILABLE:
         raise _db_unavailable_error()
     try:
         # Get game session
-        game_session = db.query(GameSession).filter(GameSession.id == request.session_id).first()
+        game_session = db.query(GameSession).filter(GameSession.id == session_id).first()
         if not game_session:
-            raise HTTPException(status_code=404, detail="Game session not found")
-        
-        # Get all related data
-        search_results = db.query(SearchResult).filter(SearchResult.game_session_id == request.session_id).all()
-        branches = db.query(Branch).filter(Branch.game_session_id == request.session_id).all()
-        leaves = db.query(Leaf).filter(Leaf.game_session_id == request.session_id).all()
-        flashcards = db.query(Flashcard).filter(Flashcard.game_session_id == request.session_id).all()
-        fruits = db.query(Fruit).filter(Fruit.game_session_id == request.session_id).all()
-        flowers = db.query(Flower).filter(Flower.game_session_id == request.session_id).all()
-        
-        # Convert to dictionaries
-        search_results_data = []
-        for result in search_results:
-            search_results_data.append({
-                "id": result.id,
-                "title": result.title,
-                "url": result.url,
-                "snippet": result.snippet,
-                "llm_content": result.llm_content,
-                "search_query": result.search_query
-            })
-        
-        branches_data = []
-        for branch in branches:
-            branches_data.append({
-                "id": branch.id,
-                "start": {"x": branch.start_x, "y": branch.start_y},
-                "end": {"x": branch.end_x, "y": branch.end_y},
-                "length": branch.length,
-                "maxLength": branch.max_length,
-                "angle": branch.angle,
-                "thickness": branch.thickness,
-                "generation": branch.generation,
-                "isGrowing": branch.is_growing,
-                "growthSpeed": branch.growth_speed,
-                "nodeType": branch.node_type,
-                "parentBranchId": branch.parent_branch_id,
-                "searchResult": {
-                    "id": branch.search_result.id if branch.search_result else None,
-                    "title": branch.search_result.title if branch.search_result else None,
-                    "url": branch.search_result.url if branch.search_result else None,
-                    "snippet": branch.search_result.snippet if branch.search_result else None,
-                    "llm_content": branch.search_result.llm_content if branch.search_result else None
-                } if branch.search_result else None
-            })
+            return _load_archived_game_state(session_id, http_request, response, db)
         
-        leaves_data = []
-        for leaf in leaves:
-            leaves_data.append({
-                "id": leaf.id,
-                "x": leaf.x,
-                "y": leaf.y,
-                "size": leaf.size,
-                "branchId": leaf.branch_id
-            })
-        
-        fruits_data = []
-        for fruit in fruits:
-            fruits_data.append({
-                "id": fruit.id,
-                "x": fruit.x,
-                "y": fruit.y,
-                "type": fruit.type,
-                "size": fruit.size
-            })
-        
-        flowers_data = []
-        for flower in flowers:
-            flowers_data.append({
-                "id": flower.id,
-                "x": flower.x,
-                "y": flower.y,
-                "type": flower.type,
-                "size": flower.size
-            })
-        
-        flashcards_data = []
-        for flashcard in flashcards:
-            flashcards_data.append({
-                "id": flashcard.id,
-                "branch_id": flashcard.branch_id,
-                "front": flashcard.front,
-                "back": flashcard.back,
-                "difficulty": flashcard.difficulty,
-                "category": flashcard.category,
-                "node_position": {
-                    "x": flashcard.node_position_x,
-                    "y": flashcard.node_position_y
-                } if flashcard.node_position_x is not None and flashcard.node_position_y is not None else None,
-                "created_at": flashcard.created_at.isoformat(),
-                "last_reviewed": flashcard.last_reviewed.isoformat() if flashcard.last_reviewed else None,
-                "review_count": flashcard.review_count
-            })
+        # Let clients holding the current copy skip the full payload
+        etag = _game_state_etag(db, game_session)
+        if etag_matches(http_request.headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers={"ETag": etag, "Cache-Control": REVALIDATE_CACHE})
+        response.headers["ETag"] = etag
+        response.headers["Cache-Control"] = REVALIDATE_CACHE
         
         return {
             "success": True,
-            "game_state": {
-                "original_search_query": game_session.original_search_query,
-                "search_results": search_results_data,
-                "branches": branches_data,
-                "leaves": leaves_data,
-                "flashcards": flashcards_data,
-                "fruits": fruits_data,
-                "flowers": flowers_data,
-                "camera_offset": {"x": game_session.camera_offset_x, "y": game_session.camera_offset_y},
-                "created_at": game_session.created_at.isoformat(),
-                "updated_at": game_session.updated_at.isoformat()
-            }
+            "game_state": serialize_game_session(db, game_session)
         }
         
     except Exception as e:
         return {"error": str(e), "success": False}
 
+@app.post("/api/load-game-state")
+@track_thread
+def load_game_state(request: LoadGameStateRequest, http_request: Request, response: Response, db: Session = Depends(get_db)):
+    return _load_game_state(request.session_id, http_request, response, db)
+
+@app.get("/api/game-state/{session_id}")
+@track_thread
+def get_game_state(session_id: int, http_request: Request, response: Response, db: Session = Depends(get_db)):
+    # Cacheable GET form of load-game-state; browsers revalidate with If-None-Match automatically
+    return _load_game_state(session_id, http_request, response, db)
+
+@app.get("/api/export-sessions")
+@track_thread
+def export_sessions():
+    if not DB_AVAILABLE:
+        raise _db_unavailable_error()
+
+    def stream():
+        # Owns its session: the request-scoped one may close before streaming finishes
+        db_session = SessionLocal()
+        try:
+            yield from export_sessions_ndjson(db_session)
+        finally:
+            db_session.close()
+
+    return StreamingResponse(
+        stream(),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": 'attachment; filename="perplexitree-sessions.ndjson"'}
+    )
+
+@app.post("/api/import-sessions")
+async def import_sessions(request: Request, db: Session = Depends(get_db)):
+    if not DB_AVAILABLE:
+        raise _db_unavailable_error()
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > MAX_IMPORT_BYTES:
+        return JSONResponse(
+            status_code=413, content={"error": f"Import exceeds {MAX_IMPORT_BYTES} bytes", "success": False}
+        )
+    importer = SessionImporter(db)
+
+    def import_lines(lines):
+        for line in lines:
+            importer.import_line(line)
+
+    buffer = bytearray()
+    scanned = 0  # Bytes of buffer already known to hold no newline
+    received = 0
+    try:
+        # Parse the NDJSON body line by line as it arrives
+        async for chunk in request.stream():
+            received += len(chunk)
+            if received > MAX_IMPORT_BYTES:
+                db.rollback()
+                return JSONResponse(status_code=413, content={
+                    "error": f"Import exceeds {MAX_IMPORT_BYTES} bytes",
+                    "success": False,
+                    "sessions_imported": importer.sessions_committed,
+                    "partial": importer.sessions_committed > 0
+                })
+            buffer += chunk
+            lines = []
+            newline = buffer.find(b"\n", scanned)
+            while newline != -1:
+                lines.append(bytes(buffer[:newline]))
+                del buffer[:newline + 1]
+                newline = buffer.find(b"\n")
+            scanned = len(buffer)
+            if lines:
+                await run_in_threadpool(import_lines, lines)
+        await run_in_threadpool(import_lines, [bytes(buffer)])
+        return {"success": True, **await run_in_threadpool(importer.finish)}
+    except Exception as e:
+        db.rollback()
+        # Batches committed before the failure stay; only the current batch is rolled back
+        return {
+            "error": str(e),
+            "success": False,
+            "sessions_imported": importer.sessions_committed,
+            "partial": importer.sessions_committed > 0
+        }
+
+@app.get("/api/prompt-metrics")
+async def get_prompt_metrics():
+    return {"success": True, "metrics": metrics.snapshot(), "budget_tokens": PROMPT_TOKEN_BUDGET}
+
+@app.on_event("startup")
+async def start_retention_scheduler():
+    if retention_scheduler is not None:
+        retention_scheduler.start()
+
+@app.on_event("shutdown")
+async def stop_retention_scheduler():
+    if retention_scheduler is not None:
+        retention_scheduler.stop()
+
+@app.get("/api/retention-status")
+async def get_retention_status():
+    if not DB_AVAILABLE:
+        raise _db_unavailable_error()
+    return {
+        "success": True,
+        "interval_seconds": retention_scheduler.interval_seconds,
+        "last_report": retention_scheduler.last_report
+    }
+
+@app.post("/api/run-retention")
+@track_thread
+def run_retention():
+    if not DB_AVAILABLE:
+        raise _db_unavailable_error()
+    try:
+        return {"success": True, "report": retention_scheduler.run_once()}
+    except Exception as e:
+        return {"error": str(e), "success": False}
+
+@app.get("/api/content-stats")
+async def get_content_stats(db: Session = Depends(get_db)):
+    if not DB_AVAILABLE:
+        raise _db_unavailable_error()
+    try:
+        return {"success": True, "stats": storage_report(db)}
+    except Exception as e:
+        return {"error": str(e), "success": False}
+
 @app.get("/api/game-sessions")
-async def get_game_sessions(db: Session = Depends(get_db)):
+async def get_game_sessions(include_archived: bool = False, db: Session = Depends(get_db)):
     if not DB_AVAILABLE:
         raise _db_unavailable_error()
     try:
-        sessions = db.query(GameSession).order_by(GameSession.updated_at.desc()).all()
+        sessions = []
+        # One shard at a time; the merged list is ordered below
+        for _ in shard_scan(db):
+            sessions.extend(db.query(GameSession).order_by(GameSession.updated_at.desc()))
         sessions_data = []
         for session in sessions:
             sessions_data.append({
@@ -483,48 +564,37 @@ async def get_game_sessions(db: Session = Depends(get_db)):
                 "created_at": session.created_at.isoformat(),
                 "updated_at": session.updated_at.isoformat()
             })
+        if include_archived:
+            # Only metadata columns; compressed payloads stay on disk until loaded
+            archived_sessions = []
+            for _ in shard_scan(db):
+                archived_sessions.extend(db.query(
+                    ArchivedSession.id, ArchivedSession.original_search_query, ArchivedSession.created_at,
+                    ArchivedSession.updated_at, ArchivedSession.archived_at
+                ))
+            for session in archived_sessions:
+                sessions_data.append({
+                    "id": session.id,
+                    "original_search_query": session.original_search_query,
+                    "created_at": session.created_at.isoformat(),
+                    "updated_at": session.updated_at.isoformat(),
+                    "archived_at": session.archived_at.isoformat()
+                })
+        sessions_data.sort(key=lambda session: session["updated_at"], reverse=True)
         return {"success": True, "sessions": sessions_data}
     except Exception as e:
         return {"error": str(e), "success": False}
 
 # Removed extra endpoint - using existing /api/create-flashcards endpoint
 
-@app.post("/api/create-flashcards")
-async def create_flashcards(request: CreateFlashcardsRequest):
-    db_session: Optional[Session] = None
-    branch = None
-    try:
-        # Handle both database branches and frontend data
-        if request.branch_id:
-            if not DB_AVAILABLE or SessionLocal is None:
-                raise _db_unavailable_error()
-            
-            db_session = SessionLocal()
-            # Database branch approach
-            branch = db_session.query(Branch).filter(Branch.id == request.branch_id).first()
-            if not branch:
-                raise HTTPException(status_code=404, detail="Branch not found")
-            
-            if not branch.search_result:
-                raise HTTPException(status_code=400, detail="Branch has no search result data")
-            
-            search_result_data = {
-                "title": branch.search_result.title,
-                "llm_content": branch.search_result.llm_content,
-                "snippet": branch.search_result.snippet
-            }
-        elif request.search_result:
-            # Frontend data approach
-            search_result_data = request.search_result
-        else:
-            raise HTTPException(status_code=400, detail="Either branch_id or search_result must be provided")
-        
-        # Use Perplexity to generate flashcards from the search result content
-        client = Perplexity()
-        
-        # Create a prompt to generate flashcards
-        flashcard_prompt = f"""
-        Based on the following content about "{search_result_data.get('title', 'Unknown Topic')}", create exactly {request.count} flashcards.
+QUIZ_QUESTION_COUNT = 5
+
+def _complete_json(prompt: str, schema: dict, client: Optional[Perplexity] = None) -> dict:
+    return json.loads(_chat_completion(prompt, schema, client))
+
+def _flashcard_prompt(title: str, content: str, count: int) -> str:
+    return f"""
+        Based on the following content about "{title}", create exactly {count} flashcards.
         Each flashcard should have a clear question on the front and a detailed, well-written answer on the back.
         Vary the answer length appropriately - simple concepts can have shorter answers (100-150 chars), while complex topics may need longer explanations (200-400 chars).
         
@@ -538,7 +608,7 @@ async def create_flashcards(request: CreateFlashcardsRequest):
         
         Focus on key concepts, definitions, and important facts.
         
-        Content: {search_result_data.get('llm_content', search_result_data.get('snippet', ''))}
+        Content: {content}
         
         Return the flashcards as a JSON array with this structure:
         [
@@ -549,83 +619,181 @@ async def create_flashcards(request: CreateFlashcardsRequest):
             }}
         ]
         """
-        
-        # Define JSON schema for structured output
-        schema = {
-            "type": "object",
-            "properties": {
-                "flashcards": {
-                    "type": "array",
-                    "items": {
-                        "type": "object",
-                        "properties": {
-                            "front": {"type": "string"},
-                            "back": {"type": "string"},
-                            "difficulty": {"type": "string", "enum": ["easy", "medium", "hard"]}
-                        },
-                        "required": ["front", "back", "difficulty"]
+
+def _flashcard_schema(count: int) -> dict:
+    return {
+        "type": "object",
+        "properties": {
+            "flashcards": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "front": {"type": "string"},
+                        "back": {"type": "string"},
+                        "difficulty": {"type": "string", "enum": ["easy", "medium", "hard"]}
                     },
-                    "minItems": request.count,
-                    "maxItems": request.count
-                }
-            },
-            "required": ["flashcards"]
-        }
+                    "required": ["front", "back", "difficulty"]
+                },
+                "minItems": count,
+                "maxItems": count
+            }
+        },
+        "required": ["flashcards"]
+    }
+
+def _render_quiz_card(card: dict) -> str:
+    return f"Q: {card.get('front', '')}\nA: {card.get('back', '')}"
+
+def _quiz_prompt(flashcard_data: str, count: int) -> str:
+    return f"""
+        Based on these flashcards, create {count} challenging multiple choice quiz questions that test understanding rather than memorization.
+        
+        Flashcards:
+        {flashcard_data}
         
-        completion = client.chat.completions.create(
-            model="sonar-pro",
-            messages=[
-                {"role": "user", "content": flashcard_prompt}
-            ],
-            response_format={
-                "type": "json_schema",
-                "json_schema": {"schema": schema}
+        For each question:
+        - Create a NEW question that tests understanding of the concepts, not just the exact flashcard content
+        - Make the correct answer shorter and more concise (50-100 characters)
+        - Create 3 plausible but incorrect alternatives that are also short and concise
+        - Make the questions challenging but fair
+        - Use normal sentence casing (not all caps)
+        
+        Return as JSON array with this structure:
+        [
+            {{
+                "question": "New challenging question",
+                "correctAnswer": "Short correct answer",
+                "options": ["Correct answer", "Wrong option 1", "Wrong option 2", "Wrong option 3"]
+            }}
+        ]
+        """
+
+def _quiz_schema(count: int) -> dict:
+    return {
+        "type": "object",
+        "properties": {
+            "questions": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "question": {"type": "string"},
+                        "correctAnswer": {"type": "string"},
+                        "options": {
+                            "type": "array",
+                            "items": {"type": "string"},
+                            "minItems": 4,
+                            "maxItems": 4
+                        }
+                    },
+                    "required": ["question", "correctAnswer", "options"]
+                },
+                "minItems": count,
+                "maxItems": count
             }
-        )
+        },
+        "required": ["questions"]
+    }
+
+def _flashcard_source(branch_id: int) -> dict:
+    if not DB_AVAILABLE or SessionLocal is None:
+        raise _db_unavailable_error()
+    db_session = SessionLocal()
+    try:
+        branch = db_session.query(Branch).filter(Branch.id == branch_id).first()
+        if not branch:
+            raise HTTPException(status_code=404, detail="Branch not found")
+        if not branch.search_result:
+            raise HTTPException(status_code=400, detail="Branch has no search result data")
+        return {
+            "title": branch.search_result.title,
+            "llm_content": branch.search_result.llm_content,
+            "snippet": branch.search_result.snippet
+        }
+    finally:
+        db_session.close()
+
+def _store_flashcards(branch_id: int, generated_flashcards: list) -> list:
+    db_session = SessionLocal()
+    try:
+        # get() pins the session to the branch's shard, so the flashcards are written beside it
+        branch = db_session.get(Branch, branch_id)
+        if not branch:
+            raise HTTPException(status_code=404, detail="Branch not found")
+        flashcards = [
+            Flashcard(
+                game_session_id=branch.game_session_id,
+                branch_id=branch.id,
+                front=flashcard_data["front"],
+                back=flashcard_data["back"],
+                difficulty=flashcard_data["difficulty"],
+                category=branch.search_result.title,
+                created_at=datetime.now(timezone.utc)
+            )
+            for flashcard_data in generated_flashcards
+        ]
+        db_session.add_all(flashcards)
+        db_session.commit()
+        return [{
+            "id": flashcard.id,
+            "front": flashcard.front,
+            "back": flashcard.back,
+            "difficulty": flashcard.difficulty,
+            "category": flashcard.category
+        } for flashcard in flashcards]
+    except Exception:
+        db_session.rollback()
+        raise
+    finally:
+        db_session.close()
+
+async def _create_flashcards(request: CreateFlashcardsRequest, client: Optional[Perplexity] = None) -> dict:
+    try:
+        # Handle both database branches and frontend data; database work runs in the threadpool
+        if request.branch_id:
+            search_result_data = await run_in_threadpool(_flashcard_source, request.branch_id)
+        elif request.search_result:
+            # Frontend data approach
+            search_result_data = request.search_result
+        else:
+            raise HTTPException(status_code=400, detail="Either branch_id or search_result must be provided")
         
-        # Parse the structured JSON response
-        response_content = completion.choices[0].message.content
-        try:
-            structured_data = json.loads(response_content)
-        except json.JSONDecodeError as e:
-            raise HTTPException(status_code=500, detail="Failed to parse flashcard data")
+        # Split oversized content so each prompt stays within the token budget
+        title = search_result_data.get('title', 'Unknown Topic')
+        content = search_result_data.get('llm_content', search_result_data.get('snippet', '')) or ""
+        chunks = chunk_text(content, content_budget(_flashcard_prompt(title, "", request.count)))
+        max_chunks = max(1, min(request.count, MAX_PROMPT_CHUNKS))
+        trimmed = len(chunks) > max_chunks
+        chunks = chunks[:max_chunks]
+        shares = split_count(request.count, len(chunks))
+        prompts = [_flashcard_prompt(title, chunk, share) for chunk, share in zip(chunks, shares)]
         
-        # Create flashcards
-        created_flashcards = []
-        for flashcard_data in structured_data.get("flashcards", []):
-            if request.branch_id:
-                # Save to database for database branches
-                flashcard = Flashcard(
-                    game_session_id=branch.game_session_id,
-                    branch_id=branch.id,
-                    front=flashcard_data["front"],
-                    back=flashcard_data["back"],
-                    difficulty=flashcard_data["difficulty"],
-                    category=branch.search_result.title,
-                    created_at=datetime.now(timezone.utc)
-                )
-                db_session.add(flashcard)
-                created_flashcards.append({
-                    "id": flashcard.id,
-                    "front": flashcard.front,
-                    "back": flashcard.back,
-                    "difficulty": flashcard.difficulty,
-                    "category": flashcard.category
-                })
-            else:
-                # Return data for frontend (not saved to database yet)
-                # Use search result title for categorization (individual topic, not root topic)
-                category = search_result_data.get('title', 'Unknown Topic')
-                created_flashcards.append({
-                    "front": flashcard_data["front"],
-                    "back": flashcard_data["back"],
-                    "difficulty": flashcard_data["difficulty"],
-                    "category": category,
-                    "node_position": request.node_position  # Include node position for linking
-                })
+        with Timer() as timer:
+            try:
+                responses = await asyncio.gather(*[
+                    run_in_threadpool(_complete_json, prompt, _flashcard_schema(share), client)
+                    for prompt, share in zip(prompts, shares)
+                ])
+            except json.JSONDecodeError:
+                raise HTTPException(status_code=500, detail="Failed to parse flashcard data")
+        metrics.record("create-flashcards", sum(map(estimate_tokens, prompts)), timer.elapsed, len(prompts), trimmed)
+        generated_flashcards = [card for response in responses for card in response.get("flashcards", [])]
         
-        if request.branch_id and db_session:
-            db_session.commit()
+        if request.branch_id:
+            # Save to database for database branches
+            created_flashcards = await run_in_threadpool(_store_flashcards, request.branch_id, generated_flashcards)
+        else:
+            # Return data for frontend (not saved to database yet)
+            # Use search result title for categorization (individual topic, not root topic)
+            category = search_result_data.get('title', 'Unknown Topic')
+            created_flashcards = [{
+                "front": flashcard_data["front"],
+                "back": flashcard_data["back"],
+                "difficulty": flashcard_data["difficulty"],
+                "category": category,
+                "node_position": request.node_position  # Include node position for linking
+            } for flashcard_data in generated_flashcards]
         
         return {
             "success": True,
@@ -634,16 +802,13 @@ async def create_flashcards(request: CreateFlashcardsRequest):
         }
         
     except HTTPException as exc:
-        if db_session:
-            db_session.rollback()
         raise exc
     except Exception as e:
-        if db_session:
-            db_session.rollback()
         return {"error": str(e), "success": False}
-    finally:
-        if db_session:
-            db_session.close()
+
+@app.post("/api/create-flashcards")
+async def create_flashcards(request: CreateFlashcardsRequest):
+    return await _create_flashcards(request)
 
 @app.get("/api/flashcards/{branch_id}")
 async def get_flashcards(branch_id: int, db: Session = Depends(get_db)):
@@ -660,7 +825,11 @@ async def get_flashcards(branch_id: int, db: Session = Depends(get_db)):
                 "category": flashcard.category,
                 "created_at": flashcard.created_at.isoformat(),
                 "last_reviewed": flashcard.last_reviewed.isoformat() if flashcard.last_reviewed else None,
-                "review_count": flashcard.review_count
+                "review_count": flashcard.review_count,
+                "ease_factor": flashcard.ease_factor,
+                "interval_days": flashcard.interval_days,
+                "repetitions": flashcard.repetitions,
+                "due_at": flashcard.due_at.isoformat() if flashcard.due_at else None
             })
         
         return {
@@ -671,18 +840,121 @@ async def get_flashcards(branch_id: int, db: Session = Depends(get_db)):
     except Exception as e:
         return {"error": str(e), "success": False}
 
+@app.post("/api/review-flashcard")
+@track_thread
+def review_flashcard(request: ReviewFlashcardRequest, db: Session = Depends(get_db)):
+    if not DB_AVAILABLE:
+        raise _db_unavailable_error()
+    try:
+        flashcard = db.query(Flashcard).filter(Flashcard.id == request.flashcard_id).first()
+        if not flashcard:
+            raise HTTPException(status_code=404, detail="Flashcard not found")
+
+        now = datetime.now(timezone.utc)
+        try:
+            schedule = next_review(
+                request.grade,
+                ease_factor=flashcard.ease_factor,
+                interval_days=flashcard.interval_days,
+                repetitions=flashcard.repetitions,
+                now=now
+            )
+        except ValueError as exc:
+            raise HTTPException(status_code=400, detail=str(exc))
+
+        flashcard.ease_factor = schedule.ease_factor
+        flashcard.interval_days = schedule.interval_days
+        flashcard.repetitions = schedule.repetitions
+        flashcard.due_at = schedule.due_at
+        flashcard.last_reviewed = now
+        flashcard.review_count = (flashcard.review_count or 0) + 1
+        db.commit()
+
+        return {
+            "success": True,
+            "flashcard": {
+                "id": flashcard.id,
+                "ease_factor": flashcard.ease_factor,
+                "interval_days": flashcard.interval_days,
+                "repetitions": flashcard.repetitions,
+                "review_count": flashcard.review_count,
+                "last_reviewed": flashcard.last_reviewed.isoformat(),
+                "due_at": flashcard.due_at.isoformat()
+            }
+        }
+
+    except HTTPException:
+        db.rollback()
+        raise
+    except Exception as e:
+        db.rollback()
+        return {"error": str(e), "success": False}
+
+@app.get("/api/due-flashcards")
+async def get_due_flashcards(session_id: Optional[int] = None, limit: int = 20, db: Session = Depends(get_db)):
+    if not DB_AVAILABLE:
+        raise _db_unavailable_error()
+    try:
+        limit = max(1, min(limit, 200))
+        now = datetime.now(timezone.utc)
+
+        # Served by ix_flashcards_session_due (per session) or ix_flashcards_due_at (all sessions),
+        # so only the first `limit` due rows are ever read
+        query = db.query(Flashcard).filter(Flashcard.due_at <= now)
+        if session_id is not None:
+            query = query.filter(Flashcard.game_session_id == session_id)
+            flashcards = query.order_by(Flashcard.due_at).limit(limit).all()
+        else:
+            # Each shard returns its own earliest `limit`; the global earliest are among them
+            flashcards = []
+            for _ in shard_scan(db):
+                flashcards.extend(query.order_by(Flashcard.due_at).limit(limit))
+            flashcards = sorted(flashcards, key=lambda flashcard: flashcard.due_at)[:limit]
+
+        flashcards_data = []
+        for flashcard in flashcards:
+            flashcards_data.append({
+                "id": flashcard.id,
+                "game_session_id": flashcard.game_session_id,
+                "branch_id": flashcard.branch_id,
+                "front": flashcard.front,
+                "back": flashcard.back,
+                "difficulty": flashcard.difficulty,
+                "category": flashcard.category,
+                "review_count": flashcard.review_count,
+                "due_at": flashcard.due_at.isoformat()
+            })
+
+        return {"success": True, "flashcards": flashcards_data}
+
+    except Exception as e:
+        return {"error": str(e), "success": False}
+
 @app.post("/api/delete-game-state")
-async def delete_game_state(request: DeleteGameStateRequest, db: Session = Depends(get_db)):
+@track_thread
+def delete_game_state(request: DeleteGameStateRequest, db: Session = Depends(get_db)):
     if not DB_AVAILABLE:
         raise _db_unavailable_error()
     try:
         # Get the game session
         game_session = db.query(GameSession).filter(GameSession.id == request.session_id).first()
         if not game_session:
-            raise HTTPException(status_code=404, detail="Game session not found")
+            archived = db.get(ArchivedSession, request.session_id)
+            if not archived:
+                raise HTTPException(status_code=404, detail="Game session not found")
+            db.delete(archived)
+            db.commit()
+            return {
+                "success": True,
+                "message": f"Archived game session {request.session_id} deleted successfully"
+            }
         
+        # Only blobs this session referenced can become orphaned by deleting it
+        content_hashes = session_content_hashes(db, game_session.id)
         # Delete the game session (cascade will handle related records)
         db.delete(game_session)
+        db.flush()
+        prune_orphan_content(db, content_hashes)
         db.commit()
         
         return {
@@ -694,103 +966,370 @@ async def delete_game_state(request: DeleteGameStateRequest, db: Session = Depen
         db.rollback()
         return {"error": str(e), "success": False}
 
-@app.post("/api/generate-quiz")
-async def generate_quiz(request: GenerateQuizRequest):
+def _stored_quiz_cards(session_id: int) -> list:
+    db_session = SessionLocal()
     try:
-        client = Perplexity()
-        
-        # Create a prompt to generate quiz questions from flashcards
-        flashcard_data = "\n".join([f"Q: {card.get('front', '')}\nA: {card.get('back', '')}" for card in request.flashcards])
-        
-        quiz_prompt = f"""
-        Based on these flashcards, create 5 challenging multiple choice quiz questions that test understanding rather than memorization.
-        
-        Flashcards:
-        {flashcard_data}
-        
-        For each question:
-        - Create a NEW question that tests understanding of the concepts, not just the exact flashcard content
-        - Make the correct answer shorter and more concise (50-100 characters)
-        - Create 3 plausible but incorrect alternatives that are also short and concise
-        - Make the questions challenging but fair
-        - Use normal sentence casing (not all caps)
-        
-        Return as JSON array with this structure:
-        [
-            {{
-                "question": "New challenging question",
-                "correctAnswer": "Short correct answer",
-                "options": ["Correct answer", "Wrong option 1", "Wrong option 2", "Wrong option 3"]
-            }}
-        ]
-        """
-        
-        # Define JSON schema for structured output
-        schema = {
-            "type": "object",
-            "properties": {
-                "questions": {
-                    "type": "array",
-                    "items": {
-                        "type": "object",
-                        "properties": {
-                            "question": {"type": "string"},
-                            "correctAnswer": {"type": "string"},
-                            "options": {
-                                "type": "array",
-                                "items": {"type": "string"},
-                                "minItems": 4,
-                                "maxItems": 4
-                            }
-                        },
-                        "required": ["question", "correctAnswer", "options"]
-                    },
-                    "minItems": 5,
-                    "maxItems": 5
-                }
-            },
-            "required": ["questions"]
-        }
-        
-        completion = client.chat.completions.create(
-            model="sonar-pro",
-            messages=[
-                {"role": "user", "content": quiz_prompt}
-            ],
-            response_format={
-                "type": "json_schema",
-                "json_schema": {"schema": schema}
-            }
-        )
-        
-        # Parse the structured JSON response
-        response_content = completion.choices[0].message.content
+        flashcards = db_session.query(
+            Flashcard.front, Flashcard.back, Flashcard.category, Flashcard.difficulty
+        ).filter(Flashcard.game_session_id == session_id).all()
+        return [{
+            "front": flashcard.front,
+            "back": flashcard.back,
+            "category": flashcard.category,
+            "difficulty": flashcard.difficulty
+        } for flashcard in flashcards]
+    finally:
+        db_session.close()
+
+async def _generate_llm_quiz(flashcards: list) -> list:
+    # Large decks are split into groups that each fit the prompt budget
+    max_content_tokens = content_budget(_quiz_prompt("", QUIZ_QUESTION_COUNT))
+    groups = chunk_items(flashcards, _render_quiz_card, max_content_tokens) or [[]]
+    max_groups = min(QUIZ_QUESTION_COUNT, MAX_PROMPT_CHUNKS)
+    trimmed = len(groups) > max_groups
+    groups = groups[:max_groups]
+    shares = split_count(QUIZ_QUESTION_COUNT, len(groups))
+    max_chars = max_content_tokens * CHARS_PER_TOKEN
+    prompts = [
+        _quiz_prompt("\n".join(_render_quiz_card(card) for card in group)[:max_chars], share)
+        for group, share in zip(groups, shares)
+    ]
+    
+    with Timer() as timer:
         try:
-            structured_data = json.loads(response_content)
-        except json.JSONDecodeError as e:
+            responses = await asyncio.gather(*[
+                run_in_threadpool(_complete_json, prompt, _quiz_schema(share))
+                for prompt, share in zip(prompts, shares)
+            ])
+        except json.JSONDecodeError:
             raise HTTPException(status_code=500, detail="Failed to parse quiz data")
-        
-        # Shuffle options for each question
-        questions = []
-        for question_data in structured_data.get("questions", []):
-            options = question_data["options"]
-            # Shuffle the options
-            import random
-            random.shuffle(options)
-            questions.append({
-                "question": question_data["question"],
-                "correctAnswer": question_data["correctAnswer"],
-                "options": options
-            })
-        
-        return {
-            "success": True,
-            "questions": questions
-        }
-        
+    metrics.record("generate-quiz", sum(map(estimate_tokens, prompts)), timer.elapsed, len(prompts), trimmed)
+    generated_questions = [question for response in responses for question in response.get("questions", [])]
+    
+    # Shuffle options for each question
+    questions = []
+    for question_data in generated_questions:
+        options = question_data["options"]
+        # Shuffle the options
+        import random
+        random.shuffle(options)
+        questions.append({
+            "question": question_data["question"],
+            "correctAnswer": question_data["correctAnswer"],
+            "options": options
+        })
+    
+    return questions
+
+@app.post("/api/generate-quiz")
+async def generate_quiz(request: GenerateQuizRequest):
+    try:
+        mode = (request.mode or QUIZ_MODE).lower()
+        if mode not in QUIZ_MODES:
+            raise HTTPException(status_code=400, detail=f"mode must be one of {', '.join(QUIZ_MODES)}")
+        flashcards = request.flashcards
+        pool = []
+        if request.session_id is not None:
+            if not DB_AVAILABLE:
+                raise _db_unavailable_error()
+            pool = await run_in_threadpool(_stored_quiz_cards, request.session_id)
+            flashcards = flashcards or pool
+
+        if mode != "llm":
+            questions = build_quiz(flashcards, QUIZ_QUESTION_COUNT, pool)
+            if mode == "local" or is_full_quiz(questions, flashcards, QUIZ_QUESTION_COUNT):
+                return {"success": True, "questions": questions, "mode": "local"}
+
+        return {"success": True, "questions": await _generate_llm_quiz(flashcards), "mode": "llm"}
+
     except Exception as e:
         return {"error": str(e), "success": False}
 
+class AppendGameStateRequest(BaseModel):
+    search_results: list = []
+    branches: list = []
+    leaves: list = []
+    fruits: list = []
+    flowers: list = []
+    flashcards: list = []
+    camera_offset: Optional[dict] = None
+
+class LiveSession:
+    """State for one /api/ws/session connection.
+
+    Commands arrive as {"id", "type", "params"} and run concurrently; replies are
+    {"id", "type": "partial" | "result" | "error", ...}. Writes to the bound game
+    session are serialized so appends land in order.
+    """
+
+    def __init__(self, websocket: WebSocket, session_id: Optional[int]):
+        self.websocket = websocket
+        self.session_id = session_id
+        # One upstream client per connection instead of one per expansion
+        self.client = Perplexity()
+        self._send_lock = asyncio.Lock()
+        self._db_lock = asyncio.Lock()
+
+    async def send(self, message: dict):
+        async with self._send_lock:
+            await self.websocket.send_json(message)
+
+    async def handle(self, message: dict):
+        command_id = message.get("id")
+        command = message.get("type")
+        params = message.get("params") or {}
+        handler = getattr(self, f"_cmd_{str(command).replace('-', '_')}", None)
+        if handler is None:
+            await self.send({"id": command_id, "type": "error", "error": f"Unknown command '{command}'"})
+            return
+        try:
+            data = await handler(command_id, params)
+            await self.send({"id": command_id, "type": "result", "data": data})
+        except ValidationError as exc:
+            await self.send({"id": command_id, "type": "error", "status": 422, "error": exc.errors()})
+        except HTTPException as exc:
+            await self.send({"id": command_id, "type": "error", "status": exc.status_code, "error": exc.detail})
+        except Exception as exc:
+            logger.exception("Live session command %s failed", command)
+            await self.send({"id": command_id, "type": "error", "status": 500, "error": str(exc)})
+
+    async def _cmd_ping(self, command_id, params):
+        return {"session_id": self.session_id}
+
+    async def _cmd_search(self, command_id, params):
+        return await run_in_threadpool(_search, SearchRequest(**params), self.client)
+
+    async def _cmd_expand(self, command_id, params):
+        # Several queries may be expanded at once; each is pushed as soon as it returns
+        queries = params.get("queries") or [params]
+        requests = [WebSearchRequest(**query) for query in queries]
+
+        def fetch(expansion: WebSearchRequest) -> list:
+            # lookup may wait on an in-flight prefetch, so it runs in the threadpool as well
+            results = expansion_prefetcher.lookup(expansion.query, expansion.count, expansion.negative_prompts)
+            if results is None:
+                results = _run_web_search(expansion.query, expansion.count, expansion.negative_prompts, self.client)
+            return results
+
+        async def expand(expansion: WebSearchRequest):
+            results = await run_in_threadpool(fetch, expansion)
+            await self.send({
+                "id": command_id,
+                "type": "partial",
+                "data": {"query": expansion.query, "results": results}
+            })
+            return {"query": expansion.query, "results": results}
+
+        return {"expansions": await asyncio.gather(*[expand(expansion) for expansion in requests])}
+
+    async def _cmd_flashcards(self, command_id, params):
+        return await _create_flashcards(CreateFlashcardsRequest(**params), self.client)
+
+    async def _cmd_bind(self, command_id, params):
+        session_id = int(params["session_id"])
+
+        def exists() -> bool:
+            db_session = self._open_db()
+            try:
+                return db_session.query(GameSession.id).filter(GameSession.id == session_id).first() is not None
+            finally:
+                db_session.close()
+
+        async with self._db_lock:
+            if not await run_in_threadpool(exists):
+                raise HTTPException(status_code=404, detail="Game session not found")
+        self.session_id = session_id
+        return {"session_id": session_id}
+
+    async def _cmd_save(self, command_id, params):
+        # Full snapshot: creates a new session and binds the connection to it
+        request = SaveGameStateRequest(**params)
+
+        def save() -> dict:
+            db_session = self._open_db()
+            try:
+                return _save_game_state(request, db_session)
+            finally:
+                db_session.close()
+
+        async with self._db_lock:
+            result = await run_in_threadpool(save)
+        if result.get("success"):
+            self.session_id = result["session_id"]
+        return result
+
+    async def _cmd_append(self, command_id, params):
+        # Incremental save: only the new entities are written to the bound session
+        request = AppendGameStateRequest(**params)
+        if self.session_id is None:
+            raise HTTPException(status_code=409, detail="No game session bound; send 'save' or 'bind' first")
+        session_id = self.session_id
+
+        def append():
+            db_session = self._open_db()
+            try:
+                game_session = db_session.get(GameSession, session_id)
+                if not game_session:
+                    raise HTTPException(status_code=404, detail="Game session not found")
+                save = StreamingSave(db_session, game_session=game_session)
+                if request.camera_offset:
+                    save.add("value", "camera_offset", request.camera_offset)
+                for key in StreamingSave.ARRAY_KEYS:
+                    for item in getattr(request, key):
+                        save.add("item", key, item)
+                save.finish()
+                db_session.commit()
+            except Exception:
+                db_session.rollback()
+                raise
+            finally:
+                db_session.close()
+
+        async with self._db_lock:
+            try:
+                await run_in_threadpool(append)
+            except InvalidSavePayload as e:
+                raise HTTPException(status_code=422, detail=str(e))
+        return {"success": True, "session_id": session_id}
+
+    def _open_db(self) -> Session:
+        if not DB_AVAILABLE:
+            raise _db_unavailable_error()
+        return SessionLocal()
+
+# Commands beyond this many unfinished ones on a connection are rejected with status 429
+MAX_WS_INFLIGHT = int(os.getenv("MAX_WS_INFLIGHT", "8"))
+
+@app.websocket("/api/ws/session")
+async def live_session(websocket: WebSocket, session_id: Optional[int] = None):
+    await websocket.accept()
+    live = LiveSession(websocket, session_id)
+    pending = set()
+    try:
+        while True:
+            try:
+                message = json.loads(await websocket.receive_text())
+            except json.JSONDecodeError:
+                await live.send({"type": "error", "error": "Invalid JSON"})
+                continue
+            if not isinstance(message, dict):
+                await live.send({"type": "error", "error": "Commands must be JSON objects"})
+                continue
+            if len(pending) >= MAX_WS_INFLIGHT:
+                await live.send({
+                    "id": message.get("id"),
+                    "type": "error",
+                    "status": 429,
+                    "error": f"At most {MAX_WS_INFLIGHT} commands may be in flight per connection"
+                })
+                continue
+            task = asyncio.ensure_future(live.handle(message))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        for task in pending:
+            task.cancel()
+
+MAX_BATCH_OPERATIONS = int(os.getenv("MAX_BATCH_OPERATIONS", "20"))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "5"))
+
+# op name -> (request model, handler(request, db, http_request), needs database)
+# Handlers doing blocking upstream or database work go through the threadpool, like the endpoints themselves
+BATCH_OPERATIONS = {
+    "search": (SearchRequest, lambda req, db, http_request: run_in_threadpool(search, req), False),
+    "web-search": (WebSearchRequest, lambda req, db, http_request: run_in_threadpool(web_search, req), False),
+    "create-flashcards": (CreateFlashcardsRequest, lambda req, db, http_request: create_flashcards(req), False),
+    "generate-quiz": (GenerateQuizRequest, lambda req, db, http_request: generate_quiz(req), False),
+    "save-game-state": (SaveGameStateRequest, lambda req, db, http_request: run_in_threadpool(_save_game_state, req, db), True),
+    "load-game-state": (
+        LoadGameStateRequest,
+        lambda req, db, http_request: run_in_threadpool(_load_game_state, req.session_id, http_request, Response(), db),
+        True
+    ),
+    "delete-game-state": (
+        DeleteGameStateRequest, lambda req, db, http_request: run_in_threadpool(delete_game_state, req, db), True
+    ),
+    "review-flashcard": (
+        ReviewFlashcardRequest, lambda req, db, http_request: run_in_threadpool(review_flashcard, req, db), True
+    ),
+}
+
+async def _run_batch_operation(operation: BatchOperation, op_id: str, http_request: Request, semaphore: asyncio.Semaphore) -> dict:
+    if operation.op not in BATCH_OPERATIONS:
+        return {"id": op_id, "op": operation.op, "status": 400, "error": f"Unknown operation '{operation.op}'"}
+    request_model, handler, needs_db = BATCH_OPERATIONS[operation.op]
+    try:
+        operation_request = request_model(**operation.params)
+    except ValidationError as exc:
+        return {"id": op_id, "op": operation.op, "status": 422, "error": exc.errors()}
+    if needs_db and not DB_AVAILABLE:
+        return {"id": op_id, "op": operation.op, "status": 503, "error": _db_unavailable_error().detail}
+
+    async with semaphore:
+        # Each operation gets its own session: sessions must not be shared across concurrent tasks
+        db_session = SessionLocal() if needs_db else None
+        try:
+            result = handler(operation_request, db_session, http_request)
+            if asyncio.iscoroutine(result) or isinstance(result, asyncio.Future):
+                result = await result
+            if isinstance(result, Response):
+                return {"id": op_id, "op": operation.op, "status": result.status_code, "result": None}
+            return {"id": op_id, "op": operation.op, "status": 200, "result": result}
+        except HTTPException as exc:
+            return {"id": op_id, "op": operation.op, "status": exc.status_code, "error": exc.detail}
+        except Exception as exc:
+            logger.exception("Batch operation %s (%s) failed", op_id, operation.op)
+            return {"id": op_id, "op": operation.op, "status": 500, "error": str(exc)}
+        finally:
+            if db_session:
+                db_session.close()
+
+def _batch_result_ok(result: dict) -> bool:
+    if result["status"] >= 400:
+        return False
+    body = result.get("result")
+    return not (isinstance(body, dict) and body.get("error"))
+
+@app.post("/api/batch")
+async def batch(request: BatchRequest, http_request: Request):
+    if not request.operations:
+        raise HTTPException(status_code=400, detail="No operations provided")
+    if len(request.operations) > MAX_BATCH_OPERATIONS:
+        raise HTTPException(status_code=400, detail=f"A batch may contain at most {MAX_BATCH_OPERATIONS} operations")
+
+    op_ids = [operation.id or str(index) for index, operation in enumerate(request.operations)]
+    if len(set(op_ids)) != len(op_ids):
+        raise HTTPException(status_code=400, detail="Operation ids must be unique")
+    for index, operation in enumerate(request.operations):
+        # Only earlier operations may be referenced, which rules out cycles
+        unknown = [dep for dep in operation.depends_on if str(dep) not in op_ids[:index]]
+        if unknown:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Operation '{op_ids[index]}' depends on unknown or later operations: {unknown}"
+            )
+
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+    tasks = {}
+
+    async def run(operation: BatchOperation, op_id: str) -> dict:
+        for dep in operation.depends_on:
+            if not _batch_result_ok(await tasks[str(dep)]):
+                return {"id": op_id, "op": operation.op, "status": 424, "error": f"Dependency '{dep}' failed"}
+        return await _run_batch_operation(operation, op_id, http_request, semaphore)
+
+    # Operations without dependencies start immediately and run concurrently
+    for operation, op_id in zip(request.operations, op_ids):
+        tasks[op_id] = asyncio.ensure_future(run(operation, op_id))
+    results = await asyncio.gather(*tasks.values())
+
+    return {
+        "success": all(_batch_result_ok(result) for result in results),
+        "results": results
+    }
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8001)
@@ -1,7 +1,12 @@
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, ForeignKey, Float, Boolean
+from sqlalchemy import create_engine, event, Column, Integer, String, Text, DateTime, ForeignKey, Float, Boolean, Index, LargeBinary, inspect, text
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.orm import Session, sessionmaker, relationship
+from sqlalchemy.schema import CreateTable
+from sqlalchemy.sql import operators, visitors
+from sqlalchemy.sql.elements import BinaryExpression, BindParameter, ColumnElement
 from datetime import datetime, timezone
+from typing import Optional
+import itertools
 import json
 import os
 
@@ -32,14 +37,65 @@ class SearchResult(Base):
     game_session_id = Column(Integer, ForeignKey("game_sessions.id"), nullable=False)
     title = Column(String, nullable=False)
     url = Column(String)
-    snippet = Column(Text)
-    llm_content = Column(Text)
+    # Bodies live in content_blobs, keyed by hash; the inline columns only hold
+    # rows written before deduplication that have not been migrated yet
+    snippet_hash = Column(String(64), ForeignKey("content_blobs.hash"), nullable=True, index=True)
+    llm_content_hash = Column(String(64), ForeignKey("content_blobs.hash"), nullable=True, index=True)
+    snippet_inline = Column("snippet", Text)
+    llm_content_inline = Column("llm_content", Text)
     search_query = Column(String)
     created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
     
     # Relationships
     game_session = relationship("GameSession", back_populates="search_results")
     branches = relationship("Branch", back_populates="search_result")
+    snippet_blob = relationship("ContentBlob", foreign_keys=[snippet_hash], lazy="joined")
+    llm_content_blob = relationship("ContentBlob", foreign_keys=[llm_content_hash], lazy="joined")
+
+    @property
+    def snippet(self):
+        if self.snippet_blob is not None:
+            return self.snippet_blob.body
+        return self.snippet_inline
+
+    @property
+    def llm_content(self):
+        if self.llm_content_blob is not None:
+            return self.llm_content_blob.body
+        return self.llm_content_inline
+
+class ContentBlob(Base):
+    __tablename__ = "content_blobs"
+
+    hash = Column(String(64), primary_key=True)  # sha256 hex digest of body
+    body = Column(Text, nullable=False)
+    size = Column(Integer, nullable=False)  # UTF-8 byte length of body
+    created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+
+class ArchivedSession(Base):
+    __tablename__ = "archived_sessions"
+
+    # Same id the session had while live, so old links keep loading
+    id = Column(Integer, primary_key=True)
+    original_search_query = Column(String, nullable=False, index=True)
+    created_at = Column(DateTime, nullable=False)
+    updated_at = Column(DateTime, nullable=False)
+    archived_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+    payload = Column(LargeBinary, nullable=False)  # zlib-compressed load-game-state JSON
+    raw_size = Column(Integer, nullable=False)
+    compressed_size = Column(Integer, nullable=False)
+
+class UpstreamRecording(Base):
+    __tablename__ = "upstream_recordings"
+
+    id = Column(Integer, primary_key=True, index=True)
+    kind = Column(String, nullable=False)  # "chat" or "search"
+    request_key = Column(String(64), nullable=False, unique=True, index=True)  # sha256 of normalized request
+    request_json = Column(Text, nullable=False)
+    response_json = Column(Text, nullable=False)
+    latency_ms = Column(Float, nullable=True)
+    recorded_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+    replay_count = Column(Integer, default=0)
 
 class Branch(Base):
     __tablename__ = "branches"
@@ -107,11 +163,22 @@ class Flashcard(Base):
     created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
     last_reviewed = Column(DateTime, nullable=True)
     review_count = Column(Integer, default=0)
+
+    # Spaced repetition (SM-2) scheduling state
+    ease_factor = Column(Float, default=2.5)
+    interval_days = Column(Float, default=0.0)
+    repetitions = Column(Integer, default=0)  # Consecutive successful reviews
+    due_at = Column(DateTime, default=lambda: datetime.now(timezone.utc), index=True)
     
     # Relationships
     game_session = relationship("GameSession", back_populates="flashcards")
     branch = relationship("Branch", back_populates="flashcards")
 
+    __table_args__ = (
+        # Per-session "due now" queue: equality on session, range scan on due_at
+        Index("ix_flashcards_session_due", "game_session_id", "due_at"),
+    )
+
 class Fruit(Base):
     __tablename__ = "fruits"
     
@@ -163,13 +230,275 @@ def _resolve_database_url() -> str:
 
 
 DATABASE_URL = _resolve_database_url()
-connect_args = {"check_same_thread": False} if DATABASE_URL.startswith("sqlite") else {}
-engine = create_engine(DATABASE_URL, connect_args=connect_args)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
-def create_tables():
-    # Only create tables if they don't exist (don't drop existing data)
-    Base.metadata.create_all(bind=engine)
+# Splitting sessions over several SQLite files gives each file its own write lock,
+# so concurrent saves of different sessions stop queueing behind one another.
+# Shard 0 is DATABASE_URL itself; shard k lives next to it as <name>.shard<k>.db.
+SQLITE_SHARDS = max(1, int(os.getenv("SQLITE_SHARDS", "1")))
+# Ids in shard k start at k * SHARD_ID_SPAN, so every entity id names its shard
+SHARD_ID_SPAN = 10 ** 12
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+
+# Tables with integer surrogate keys that must not collide across shards
+_SHARDED_ID_TABLES = ("game_sessions", "search_results", "branches", "leaves", "flashcards", "fruits", "flowers")
+for _table_name in _SHARDED_ID_TABLES:
+    # AUTOINCREMENT makes SQLite honour the seeded sqlite_sequence in new shard files
+    Base.metadata.tables[_table_name].dialect_kwargs["sqlite_autoincrement"] = True
+
+# Kept whole on shard 0 rather than split: replay recordings are keyed by request, not session.
+# Content blobs are not listed: each shard stores the blobs its own search results reference.
+_PRIMARY_SHARD_TABLES = ("upstream_recordings",)
+
+
+def shard_url(database_url: str, shard_index: int) -> str:
+    if shard_index == 0:
+        return database_url
+    root, extension = os.path.splitext(database_url)
+    return f"{root}.shard{shard_index}{extension or '.db'}"
+
+
+def _create_engine(url: str):
+    if not url.startswith("sqlite"):
+        return create_engine(url)
+    shard_engine = create_engine(url, connect_args={"check_same_thread": False})
+
+    @event.listens_for(shard_engine, "connect")
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        # Wait for the write lock instead of failing immediately with "database is locked";
+        # set first so the pragmas below also wait for other processes' locks
+        cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        # Only takes effect on a new database (or after VACUUM); lets compaction
+        # reclaim free pages incrementally instead of with a blocking full VACUUM
+        cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        # Readers no longer block the writer, and commits skip the per-transaction fsync of
+        # the rollback journal; NORMAL is still durable against application crashes
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.execute("PRAGMA cache_size=-16000")  # 16 MB per connection
+        cursor.close()
+
+    return shard_engine
+
+
+def shard_for_id(entity_id: int) -> int:
+    return entity_id // SHARD_ID_SPAN
+
+
+class ShardRouter:
+    """Engines for every shard plus round-robin placement of new sessions."""
+
+    def __init__(self, database_url: str, shard_count: int, first_shard: Optional[int] = None):
+        if shard_count > 1 and not database_url.startswith("sqlite"):
+            raise ValueError("SQLITE_SHARDS > 1 requires a SQLite DATABASE_URL")
+        self.engines = [_create_engine(shard_url(database_url, index)) for index in range(shard_count)]
+        # Worker processes each run their own router; starting at different shards keeps
+        # their round-robins from placing new sessions on the same file in lockstep
+        self._next_shard = itertools.count(os.getpid() if first_shard is None else first_shard)
+
+    @property
+    def sharded(self) -> bool:
+        return len(self.engines) > 1
+
+    def shard_of(self, entity_id) -> Optional[int]:
+        if not isinstance(entity_id, int) or isinstance(entity_id, bool):
+            return None
+        index = shard_for_id(entity_id)
+        return index if 0 <= index < len(self.engines) else None
+
+    def place_new_session(self) -> int:
+        # Everything a session owns is written to the shard it was placed on
+        return next(self._next_shard) % len(self.engines)
+
+    def session_factories(self) -> list:
+        """One plain sessionmaker per shard, for per-file maintenance work."""
+        return [sessionmaker(autocommit=False, autoflush=False, bind=shard_engine) for shard_engine in self.engines]
+
+    def sessionmaker(self):
+        if not self.sharded:
+            return sessionmaker(autocommit=False, autoflush=False, bind=self.engines[0])
+        return sessionmaker(class_=RoutingSession, router=self, autocommit=False, autoflush=False)
+
+
+def _pinned_shards(router: ShardRouter, clause) -> set:
+    """Shards named by `<...>id == N` or `<...>id IN (...)` comparisons in a statement."""
+    shards = set()
+    for element in visitors.iterate(clause):
+        if not isinstance(element, BinaryExpression) or element.operator not in (operators.eq, operators.in_op):
+            continue
+        column, value = element.left, element.right
+        if not isinstance(column, ColumnElement) or not isinstance(value, BindParameter):
+            continue
+        name = getattr(column, "name", None) or ""
+        if name != "id" and not name.endswith("_id"):
+            continue
+        values = value.value if isinstance(value.value, (list, tuple)) else [value.value]
+        for item in values:
+            shard = router.shard_of(item)
+            if shard is not None:
+                shards.add(shard)
+    return shards
+
+
+class RoutingSession(Session):
+    """Session that sends each statement to the shard of the game session it concerns.
+
+    Ids are unique across shards, so one identity map can safely hold rows from
+    several files. A session works against one shard at a time: the shard of the
+    last id it filtered on or loaded, or a freshly placed one for a new game
+    session. Writes, including bulk inserts and content blobs, go there too.
+    Reads that must span every shard iterate with shard_scan().
+    """
+
+    def __init__(self, router: ShardRouter, **kwargs):
+        super().__init__(**kwargs)
+        self.router = router
+        self.shard: Optional[int] = None
+        self._scan_shard: Optional[int] = None
+
+    def get(self, entity, ident, **kwargs):
+        shard = self.router.shard_of(ident)
+        if shard is not None and self._scan_shard is None:
+            self.shard = shard
+        return super().get(entity, ident, **kwargs)
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        mapper_info = inspect(mapper, raiseerr=False) if mapper is not None else None
+        table = getattr(mapper_info, "local_table", None)
+        if table is not None and table.name in _PRIMARY_SHARD_TABLES:
+            return self.router.engines[0]
+        if self._scan_shard is not None:
+            return self.router.engines[self._scan_shard]
+        if clause is not None:
+            pinned = _pinned_shards(self.router, clause)
+            if pinned:
+                self.shard = self.shard if self.shard in pinned else min(pinned)
+        if self.shard is None and table is not None and table.name == "game_sessions" and clause is None:
+            # Flushing a brand-new session with nothing loaded yet
+            self.shard = self.router.place_new_session()
+        return self.router.engines[self.shard or 0]
+
+
+def route_new_session(db: Session):
+    """Place the next new GameSession, and the rows written after it, on a fresh shard."""
+    if isinstance(db, RoutingSession):
+        db.flush()
+        db.shard = db.router.place_new_session()
+
+
+def shard_scan(db: Session):
+    """Yield once per shard with every statement pinned to it; once for an unsharded session."""
+    if not isinstance(db, RoutingSession):
+        yield 0
+        return
+    previous = db._scan_shard
+    try:
+        for index in range(len(db.router.engines)):
+            db._scan_shard = index
+            yield index
+    finally:
+        db._scan_shard = previous
+
+
+router = ShardRouter(DATABASE_URL, SQLITE_SHARDS)
+engines = router.engines
+# Shard 0: the original database file, and home of the non-sharded tables
+engine = engines[0]
+SessionLocal = router.sessionmaker()
+# Unrouted sessions bound to a single shard file
+shard_session_factories = router.session_factories()
+
+# Columns added after the initial schema. create_all() never alters existing
+# tables, so older databases get them via ALTER TABLE on startup.
+_ADDED_COLUMNS = {
+    "flashcards": [
+        ("ease_factor", "FLOAT DEFAULT 2.5"),
+        ("interval_days", "FLOAT DEFAULT 0.0"),
+        ("repetitions", "INTEGER DEFAULT 0"),
+        ("due_at", "TIMESTAMP"),
+    ],
+    "search_results": [
+        ("snippet_hash", "VARCHAR(64)"),
+        ("llm_content_hash", "VARCHAR(64)"),
+    ],
+}
+
+# Backfills that must run once the columns above exist
+_BACKFILLS = [
+    "UPDATE flashcards SET due_at = created_at WHERE due_at IS NULL",
+]
+
+def _migrate_columns(shard_engine):
+    inspector = inspect(shard_engine)
+    existing_tables = set(inspector.get_table_names())
+    with shard_engine.begin() as conn:
+        for table, columns in _ADDED_COLUMNS.items():
+            if table not in existing_tables:
+                continue
+            present = {column["name"] for column in inspector.get_columns(table)}
+            for name, ddl in columns:
+                if name not in present:
+                    conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {name} {ddl}"))
+        for statement in _BACKFILLS:
+            conn.execute(text(statement))
+
+def _seed_id_range(shard_engine, shard_index: int):
+    """Start a new shard's ids at shard_index * SHARD_ID_SPAN; no-op once rows exist."""
+    with shard_engine.begin() as conn:
+        for table in _SHARDED_ID_TABLES:
+            conn.execute(text(
+                "INSERT INTO sqlite_sequence (name, seq) SELECT :name, :seq "
+                "WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = :name)"
+            ), {"name": table, "seq": shard_index * SHARD_ID_SPAN - 1})
+
+def _reserve_session_ids(shard_engine):
+    """Never hand out a game session id again once it was used, archived or deleted.
+
+    Databases created before sharding have a plain INTEGER PRIMARY KEY game_sessions
+    table, for which SQLite reuses the highest id after that row is deleted; it is
+    rebuilt with AUTOINCREMENT, and the sequence is raised above archived ids.
+    """
+    if shard_engine.dialect.name != "sqlite":
+        return
+    table = Base.metadata.tables["game_sessions"]
+    with shard_engine.begin() as conn:
+        ddl = conn.execute(text(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'game_sessions'"
+        )).scalar()
+        if ddl and "AUTOINCREMENT" not in ddl.upper():
+            present = {column["name"] for column in inspect(conn).get_columns("game_sessions")}
+            columns = ", ".join(column.name for column in table.columns if column.name in present)
+            create = str(CreateTable(table).compile(dialect=shard_engine.dialect))
+            conn.execute(text("DROP TABLE IF EXISTS game_sessions_rebuild"))
+            conn.execute(text(create.replace("CREATE TABLE game_sessions", "CREATE TABLE game_sessions_rebuild", 1)))
+            conn.execute(text(f"INSERT INTO game_sessions_rebuild ({columns}) SELECT {columns} FROM game_sessions"))
+            # foreign_keys is off, so dropping the parent leaves child rows alone
+            conn.execute(text("DROP TABLE game_sessions"))
+            conn.execute(text("ALTER TABLE game_sessions_rebuild RENAME TO game_sessions"))
+            for index in table.indexes:
+                index.create(bind=conn, checkfirst=True)
+        conn.execute(text(
+            "INSERT INTO sqlite_sequence (name, seq) SELECT 'game_sessions', (SELECT COALESCE(MAX(id), 0) FROM game_sessions) "
+            "WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = 'game_sessions')"
+        ))
+        conn.execute(text(
+            "UPDATE sqlite_sequence SET seq = (SELECT MAX(id) FROM archived_sessions) "
+            "WHERE name = 'game_sessions' AND seq < (SELECT COALESCE(MAX(id), 0) FROM archived_sessions)"
+        ))
+
+def create_tables(shard_engines=None):
+    for shard_index, shard_engine in enumerate(shard_engines or engines):
+        # Only create tables if they don't exist (don't drop existing data)
+        Base.metadata.create_all(bind=shard_engine)
+        _migrate_columns(shard_engine)
+        # Indexes on migrated columns are skipped by create_all when the table already existed
+        for table in _ADDED_COLUMNS:
+            for index in Base.metadata.tables[table].indexes:
+                index.create(bind=shard_engine, checkfirst=True)
+        if shard_index > 0:
+            _seed_id_range(shard_engine, shard_index)
+        _reserve_session_ids(shard_engine)
 
 def get_db():
     db = SessionLocal()
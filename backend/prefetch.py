@@ -0,0 +1,153 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+PREFETCH_ENABLED = os.getenv("SPECULATIVE_PREFETCH", "false").lower() in ("1", "true", "yes")
+PREFETCH_CONCURRENCY = int(os.getenv("PREFETCH_CONCURRENCY", "2"))
+PREFETCH_MAX_PER_MINUTE = int(os.getenv("PREFETCH_MAX_PER_MINUTE", "20"))
+PREFETCH_TTL_SECONDS = int(os.getenv("PREFETCH_TTL_SECONDS", "600"))
+PREFETCH_CACHE_SIZE = int(os.getenv("PREFETCH_CACHE_SIZE", "500"))
+# How long a request waits on a prefetch that is already running before calling upstream itself
+PREFETCH_WAIT_SECONDS = float(os.getenv("PREFETCH_WAIT_SECONDS", "15"))
+
+# Mirrors the child-expansion query built in frontend/js/searchManager.js
+CHILD_QUERY_TEMPLATE = "deep research on {topic} in the context of {query}"
+# The frontend asks for max(5, branches - collected + 2) results with 3-5 branches,
+# so up to 7; lookup slices the prefetched list down to what was asked for
+CHILD_RESULT_COUNT = 7
+
+CacheKey = Tuple[str, Tuple[str, ...]]
+
+
+def cache_key(query: str, negative_prompts: Sequence[str]) -> CacheKey:
+    return (
+        query.strip().lower(),
+        tuple(sorted(str(prompt).strip().lower() for prompt in negative_prompts or [])),
+    )
+
+
+class _Entry:
+    __slots__ = ("future", "count", "created", "used")
+
+    def __init__(self, future: Future, count: int):
+        self.future = future
+        self.count = count
+        self.created = time.monotonic()
+        self.used = False
+
+
+class ExpansionPrefetcher:
+    """Warms web-search expansions in the background under a concurrency and rate budget."""
+
+    def __init__(
+        self,
+        fetch: Callable[[str, int, List[str]], list],
+        concurrency: int = PREFETCH_CONCURRENCY,
+        max_per_minute: int = PREFETCH_MAX_PER_MINUTE,
+        ttl_seconds: int = PREFETCH_TTL_SECONDS,
+        cache_size: int = PREFETCH_CACHE_SIZE,
+    ):
+        self._fetch = fetch
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="prefetch")
+        self._max_per_minute = max_per_minute
+        self._ttl = ttl_seconds
+        self._cache_size = cache_size
+        self._entries: "OrderedDict[CacheKey, _Entry]" = OrderedDict()
+        self._recent_starts: List[float] = []
+        self._lock = threading.Lock()
+        self._stats = {
+            "scheduled": 0,
+            "skipped_budget": 0,
+            "errors": 0,
+            "hits": 0,
+            "inflight_hits": 0,
+            "misses": 0,
+            "useful": 0,
+            "wasted": 0,
+        }
+
+    def schedule(self, query: str, count: int = CHILD_RESULT_COUNT, negative_prompts: Sequence[str] = ()) -> bool:
+        key = cache_key(query, negative_prompts)
+        with self._lock:
+            self._evict_expired()
+            existing = self._entries.get(key)
+            if existing and existing.count >= count:
+                return False
+            now = time.monotonic()
+            self._recent_starts = [started for started in self._recent_starts if now - started < 60]
+            if len(self._recent_starts) >= self._max_per_minute:
+                self._stats["skipped_budget"] += 1
+                return False
+            self._recent_starts.append(now)
+            future = self._executor.submit(self._run, query, count, list(negative_prompts))
+            self._entries[key] = _Entry(future, count)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._cache_size:
+                _, evicted = self._entries.popitem(last=False)
+                self._count_if_wasted(evicted)
+            self._stats["scheduled"] += 1
+            return True
+
+    def _run(self, query: str, count: int, negative_prompts: List[str]) -> list:
+        try:
+            return self._fetch(query, count, negative_prompts)
+        except Exception:
+            with self._lock:
+                self._stats["errors"] += 1
+            logger.warning("Prefetch failed for %r", query, exc_info=True)
+            raise
+
+    def lookup(self, query: str, count: int, negative_prompts: Sequence[str]) -> Optional[list]:
+        """Return prefetched results for this request, waiting on an in-flight prefetch if needed."""
+        key = cache_key(query, negative_prompts)
+        with self._lock:
+            self._evict_expired()
+            entry = self._entries.get(key)
+            if entry is None or entry.count < count:
+                # Only count misses once prefetching is in use, so hit rate stays meaningful
+                if self._stats["scheduled"]:
+                    self._stats["misses"] += 1
+                return None
+            in_flight = not entry.future.done()
+
+        try:
+            results = entry.future.result(timeout=PREFETCH_WAIT_SECONDS)
+        except Exception:
+            with self._lock:
+                self._stats["misses"] += 1
+                self._entries.pop(key, None)
+            return None
+
+        with self._lock:
+            if not entry.used:
+                entry.used = True
+                self._stats["useful"] += 1
+            self._stats["inflight_hits" if in_flight else "hits"] += 1
+        return results[:count]
+
+    def _evict_expired(self):
+        now = time.monotonic()
+        expired = [key for key, entry in self._entries.items() if now - entry.created > self._ttl]
+        for key in expired:
+            self._count_if_wasted(self._entries.pop(key))
+
+    def _count_if_wasted(self, entry: _Entry):
+        if not entry.used:
+            self._stats["wasted"] += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["cached"] = len(self._entries)
+        served = stats["hits"] + stats["inflight_hits"]
+        lookups = served + stats["misses"]
+        stats["hit_rate"] = round(served / lookups, 3) if lookups else None
+        # Share of upstream prefetch calls that ended up serving a request
+        stats["useful_rate"] = round(stats["useful"] / stats["scheduled"], 3) if stats["scheduled"] else None
+        return stats
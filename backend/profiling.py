@@ -0,0 +1,270 @@
+import contextvars
+import functools
+import hmac
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Optional
+
+from starlette.concurrency import run_in_threadpool as _starlette_run_in_threadpool
+
+# Profiling is off unless a token is configured; requests opt in with X-Profile: <token>
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")
+PROFILE_HEADER = b"x-profile"
+PROFILE_SAMPLE_INTERVAL_MS = float(os.getenv("PROFILE_SAMPLE_INTERVAL_MS", "5"))
+PROFILE_REPORTS_KEPT = int(os.getenv("PROFILE_REPORTS_KEPT", "20"))
+MAX_TIMELINE_EVENTS = 5000
+
+_active_profile: contextvars.ContextVar = contextvars.ContextVar("active_profile", default=None)
+_reports: "OrderedDict[str, dict]" = OrderedDict()
+_reports_lock = threading.Lock()
+
+
+def profiling_enabled() -> bool:
+    return bool(PROFILE_TOKEN)
+
+
+def token_matches(token: Optional[str]) -> bool:
+    return bool(PROFILE_TOKEN) and bool(token) and hmac.compare_digest(token.encode("utf-8"), PROFILE_TOKEN.encode("utf-8"))
+
+
+def _is_idle_event_loop(frame) -> bool:
+    # The request thread is the shared event loop; waiting in select() is not this request's work
+    code = frame.f_code
+    return code.co_name == "select" and os.path.basename(code.co_filename) == "selectors.py"
+
+
+class _StackSampler(threading.Thread):
+    """Samples call stacks of the threads currently working for one profiled request."""
+
+    def __init__(self, thread_ids, interval_seconds: float):
+        super().__init__(name="profile-sampler", daemon=True)
+        self.thread_ids = thread_ids
+        self.interval_seconds = interval_seconds
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval_seconds):
+            self.samples += 1
+            frames = sys._current_frames()
+            for thread_id in self.thread_ids():
+                frame = frames.get(thread_id)
+                if frame is not None and _is_idle_event_loop(frame):
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                if stack:
+                    self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+class RequestProfile:
+    def __init__(self, method: str, path: str):
+        self.id = uuid.uuid4().hex[:16]
+        self.method = method
+        self.path = path
+        self.started_at = datetime.now(timezone.utc)
+        self.started = time.perf_counter()
+        self.timeline = []
+        self.status = None
+        self._lock = threading.Lock()
+        self._request_thread_id = threading.get_ident()
+        # Worker thread ident -> calls, spans and statements it is running for this request.
+        # Pool threads are shared, so they are only sampled while they carry this profile.
+        self._worker_threads = Counter()
+        self._sampler = _StackSampler(self.sampled_thread_ids, PROFILE_SAMPLE_INTERVAL_MS / 1000)
+
+    def start(self):
+        self._sampler.start()
+
+    def enter_thread(self):
+        with self._lock:
+            self._worker_threads[threading.get_ident()] += 1
+
+    def leave_thread(self):
+        thread_id = threading.get_ident()
+        with self._lock:
+            self._worker_threads[thread_id] -= 1
+            if self._worker_threads[thread_id] <= 0:
+                del self._worker_threads[thread_id]
+
+    def sampled_thread_ids(self) -> set:
+        with self._lock:
+            return {self._request_thread_id, *self._worker_threads}
+
+    def add_event(self, category: str, label: str, started: float, duration: float, **details):
+        with self._lock:
+            if len(self.timeline) >= MAX_TIMELINE_EVENTS:
+                return
+            self.timeline.append({
+                "category": category,
+                "label": label,
+                "start_ms": round((started - self.started) * 1000, 3),
+                "duration_ms": round(duration * 1000, 3),
+                "thread": threading.current_thread().name,
+                **details
+            })
+
+    def finish(self) -> dict:
+        duration = time.perf_counter() - self.started
+        self._sampler.stop()
+        summary = {}
+        for event in self.timeline:
+            category = summary.setdefault(event["category"], {"count": 0, "total_ms": 0.0})
+            category["count"] += 1
+            category["total_ms"] = round(category["total_ms"] + event["duration_ms"], 3)
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "status": self.status,
+            "started_at": self.started_at.isoformat(),
+            "duration_ms": round(duration * 1000, 3),
+            "sample_interval_ms": PROFILE_SAMPLE_INTERVAL_MS,
+            "samples": self._sampler.samples,
+            "summary": summary,
+            "timeline": sorted(self.timeline, key=lambda event: event["start_ms"]),
+            "stacks": [
+                {"stack": stack, "count": count} for stack, count in self._sampler.stacks.most_common()
+            ],
+        }
+
+
+@contextmanager
+def span(category: str, label: str, **details):
+    """Time a block on the active request profile; a no-op when the request is not profiled."""
+    profile = _active_profile.get()
+    if profile is None:
+        yield
+        return
+    profile.enter_thread()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.add_event(category, label, started, time.perf_counter() - started, **details)
+        profile.leave_thread()
+
+
+def track_thread(func):
+    """Sample the thread running func for the active profile, for the whole call.
+
+    For work dispatched to the threadpool: the profile reaches the worker through the
+    copied context, but the sampler only sees threads that register themselves.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        profile = _active_profile.get()
+        if profile is None:
+            return func(*args, **kwargs)
+        profile.enter_thread()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profile.leave_thread()
+
+    return wrapper
+
+
+async def run_in_threadpool(func, *args, **kwargs):
+    """starlette's run_in_threadpool, with the worker sampled for the active profile."""
+    return await _starlette_run_in_threadpool(track_thread(func), *args, **kwargs)
+
+
+def install_sql_tracing(engine):
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        profile = _active_profile.get()
+        if profile is not None:
+            profile.enter_thread()
+            conn.info.setdefault("profile_query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        profile = _active_profile.get()
+        starts = conn.info.get("profile_query_start")
+        if profile is None or not starts:
+            return
+        started = starts.pop()
+        profile.leave_thread()
+        rowcount = cursor.rowcount if cursor.rowcount is not None and cursor.rowcount >= 0 else None
+        profile.add_event(
+            "sql", " ".join(statement.split())[:500], started, time.perf_counter() - started,
+            executemany=executemany, rowcount=rowcount
+        )
+
+
+    @event.listens_for(engine, "handle_error")
+    def _handle_error(context):
+        # A failed statement never reaches after_cursor_execute
+        profile = _active_profile.get()
+        starts = context.connection.info.get("profile_query_start") if context.connection is not None else None
+        if profile is not None and starts:
+            starts.pop()
+            profile.leave_thread()
+
+
+def get_report(report_id: str) -> Optional[dict]:
+    with _reports_lock:
+        return _reports.get(report_id)
+
+
+def collapsed_stacks(report: dict) -> str:
+    """Brendan Gregg's folded format, for flamegraph.pl / speedscope."""
+    return "".join(f"{entry['stack']} {entry['count']}\n" for entry in report["stacks"])
+
+
+def _store_report(report: dict):
+    with _reports_lock:
+        _reports[report["id"]] = report
+        while len(_reports) > PROFILE_REPORTS_KEPT:
+            _reports.popitem(last=False)
+
+
+class ProfilingMiddleware:
+    """ASGI middleware; only installed when PROFILE_TOKEN is set."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        token = dict(scope.get("headers") or []).get(PROFILE_HEADER)
+        if token is None or not token_matches(token.decode("latin-1")):
+            await self.app(scope, receive, send)
+            return
+
+        profile = RequestProfile(scope.get("method", ""), scope.get("path", ""))
+        reset_token = _active_profile.set(profile)
+        profile.start()
+
+        async def send_with_report_header(message):
+            if message["type"] == "http.response.start":
+                profile.status = message["status"]
+                headers = list(message.get("headers") or [])
+                headers.append((b"x-profile-report", f"/api/profiles/{profile.id}".encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_report_header)
+        finally:
+            _active_profile.reset(reset_token)
+            _store_report(profile.finish())
@@ -0,0 +1,136 @@
+import os
+import re
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, List, Sequence
+
+# Rough average for English text with the sonar tokenizers; no tokenizer dependency needed
+CHARS_PER_TOKEN = 4
+
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "3000"))
+MAX_PROMPT_CHUNKS = int(os.getenv("MAX_PROMPT_CHUNKS", "4"))
+
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+
+def estimate_tokens(text: str) -> int:
+    if not text:
+        return 0
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def content_budget(template: str, budget: int = None) -> int:
+    """Tokens left for inserted content once the fixed prompt text is accounted for."""
+    budget = budget or PROMPT_TOKEN_BUDGET
+    return max(budget - estimate_tokens(template), 200)
+
+
+def chunk_text(text: str, max_tokens: int) -> List[str]:
+    """Split text on paragraph, then sentence, then character boundaries to fit max_tokens."""
+    if estimate_tokens(text) <= max_tokens:
+        return [text]
+
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    pieces: List[str] = []
+    for paragraph in text.split("\n\n"):
+        if len(paragraph) <= max_chars:
+            pieces.append(paragraph)
+            continue
+        for sentence in _SENTENCE_END.split(paragraph):
+            while len(sentence) > max_chars:
+                pieces.append(sentence[:max_chars])
+                sentence = sentence[max_chars:]
+            pieces.append(sentence)
+
+    chunks: List[str] = []
+    current = ""
+    for piece in pieces:
+        candidate = f"{current}\n\n{piece}" if current else piece
+        if len(candidate) > max_chars and current:
+            chunks.append(current)
+            current = piece
+        else:
+            current = candidate
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def chunk_items(items: Sequence, render: Callable[[object], str], max_tokens: int) -> List[List]:
+    """Group items into consecutive runs whose rendered text fits max_tokens."""
+    groups: List[List] = []
+    current: List = []
+    used = 0
+    for item in items:
+        # An oversized item still gets a group of its own; callers truncate its text
+        cost = min(estimate_tokens(render(item)), max_tokens)
+        if current and used + cost > max_tokens:
+            groups.append(current)
+            current, used = [], 0
+        current.append(item)
+        used += cost
+    if current:
+        groups.append(current)
+    return groups
+
+
+def split_count(total: int, parts: int) -> List[int]:
+    """Spread total across parts as evenly as possible, larger shares first."""
+    base, remainder = divmod(total, parts)
+    return [base + (1 if i < remainder else 0) for i in range(parts)]
+
+
+class PromptMetrics:
+    """Thread-safe per-endpoint counters for prompt size and upstream latency."""
+
+    def __init__(self, window: int = 200):
+        self._lock = threading.Lock()
+        self._window = window
+        self._stats: Dict[str, dict] = {}
+
+    def record(self, endpoint: str, prompt_tokens: int, latency_seconds: float, chunks: int = 1, trimmed: bool = False):
+        with self._lock:
+            stats = self._stats.setdefault(endpoint, {
+                "requests": 0,
+                "chunked_requests": 0,
+                "trimmed_requests": 0,
+                "upstream_calls": 0,
+                "prompt_tokens_total": 0,
+                "prompt_tokens_max": 0,
+                "latencies": deque(maxlen=self._window),
+            })
+            stats["requests"] += 1
+            stats["chunked_requests"] += 1 if chunks > 1 else 0
+            stats["trimmed_requests"] += 1 if trimmed else 0
+            stats["upstream_calls"] += chunks
+            stats["prompt_tokens_total"] += prompt_tokens
+            stats["prompt_tokens_max"] = max(stats["prompt_tokens_max"], prompt_tokens)
+            stats["latencies"].append(latency_seconds)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            result = {}
+            for endpoint, stats in self._stats.items():
+                latencies = sorted(stats["latencies"])
+                result[endpoint] = {
+                    key: value for key, value in stats.items() if key != "latencies"
+                }
+                result[endpoint]["prompt_tokens_avg"] = round(stats["prompt_tokens_total"] / stats["requests"], 1)
+                result[endpoint]["latency_ms_p50"] = round(latencies[len(latencies) // 2] * 1000, 1)
+                result[endpoint]["latency_ms_p95"] = round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000, 1)
+                result[endpoint]["latency_ms_max"] = round(latencies[-1] * 1000, 1)
+            return result
+
+
+metrics = PromptMetrics()
+
+
+class Timer:
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.elapsed = time.perf_counter() - self.started
+        return False
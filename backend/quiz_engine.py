@@ -0,0 +1,102 @@
+import os
+import random
+from typing import Iterable, List, Optional
+
+# local: build questions from the flashcards themselves, no upstream call
+# llm:   have the model write new questions (slower, costs a completion)
+# auto:  local when the deck yields a full quiz, otherwise llm
+QUIZ_MODES = ("local", "llm", "auto")
+QUIZ_MODE = os.getenv("QUIZ_MODE", "auto").lower()
+OPTIONS_PER_QUESTION = 4
+
+# Distractor ranking weights; a small random jitter keeps repeated quizzes from looking identical
+CATEGORY_WEIGHT = 1.0
+LENGTH_WEIGHT = 1.0
+JITTER = 0.15
+
+
+def _normalize(text) -> str:
+    return " ".join(str(text or "").split())
+
+
+def _question_text(front: str) -> str:
+    # Fronts are either questions or bare terms
+    if front.endswith("?"):
+        return front
+    return f"Which of these best describes {front.rstrip('.:')}?"
+
+
+def distractor_score(answer: dict, candidate: dict) -> float:
+    """Higher for wrong answers that look like the right one: same category, similar length."""
+    score = 0.0
+    category = _normalize(answer.get("category")).lower()
+    if category and category == _normalize(candidate.get("category")).lower():
+        score += CATEGORY_WEIGHT
+    answer_length = len(_normalize(answer.get("back")))
+    candidate_length = len(_normalize(candidate.get("back")))
+    if answer_length and candidate_length:
+        score += LENGTH_WEIGHT * min(answer_length, candidate_length) / max(answer_length, candidate_length)
+    return score
+
+
+def build_quiz(
+    flashcards: Iterable[dict],
+    count: int,
+    pool: Iterable[dict] = (),
+    min_options: int = 2,
+    rng: Optional[random.Random] = None,
+) -> List[dict]:
+    """Multiple-choice questions from flashcards, using other cards' answers as distractors.
+
+    Questions are asked about `flashcards`; distractors come from those cards plus
+    `pool` (e.g. the rest of the session's deck). Questions with fewer than
+    `min_options` options are dropped.
+    """
+    rng = rng or random.Random()
+
+    def usable(cards):
+        for card in cards:
+            front, back = _normalize(card.get("front")), _normalize(card.get("back"))
+            if front and back:
+                yield {**card, "front": front, "back": back}
+
+    askable = list(usable(flashcards))
+    # One candidate per distinct answer so the correct answer never reappears as a distractor
+    candidates = {}
+    for card in askable + list(usable(pool)):
+        candidates.setdefault(card["back"].lower(), card)
+
+    rng.shuffle(askable)
+    asked = set()
+    questions = []
+    for card in askable:
+        if len(questions) >= count:
+            break
+        answer_key = card["back"].lower()
+        if answer_key in asked:
+            continue
+        asked.add(answer_key)
+        ranked = sorted(
+            (candidate for key, candidate in candidates.items() if key != answer_key),
+            key=lambda candidate: distractor_score(card, candidate) + rng.random() * JITTER,
+            reverse=True
+        )
+        options = [card["back"]] + [candidate["back"] for candidate in ranked[:OPTIONS_PER_QUESTION - 1]]
+        if len(options) < min_options:
+            continue
+        rng.shuffle(options)
+        questions.append({
+            "question": _question_text(card["front"]),
+            "correctAnswer": card["back"],
+            "options": options
+        })
+    return questions
+
+
+def is_full_quiz(questions: List[dict], flashcards: Iterable[dict], count: int) -> bool:
+    """True when the local quiz is as long as the deck allows and every question has all options."""
+    distinct_answers = {_normalize(card.get("back")).lower() for card in flashcards if _normalize(card.get("back"))}
+    expected = min(count, len(distinct_answers))
+    return bool(questions) and len(questions) >= expected and all(
+        len(question["options"]) == OPTIONS_PER_QUESTION for question in questions
+    )
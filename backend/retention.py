@@ -0,0 +1,234 @@
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from typing import Callable, List, Optional, Sequence
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from content_store import prune_orphan_content, session_content_hashes
+from models import ArchivedSession, GameSession, shard_scan
+from session_transfer import serialize_game_session
+
+logger = logging.getLogger(__name__)
+
+# 0 disables a policy
+RETENTION_KEEP_LATEST_PER_QUERY = int(os.getenv("RETENTION_KEEP_LATEST_PER_QUERY", "0"))
+RETENTION_ARCHIVE_AFTER_DAYS = int(os.getenv("RETENTION_ARCHIVE_AFTER_DAYS", "0"))
+RETENTION_INTERVAL_SECONDS = int(os.getenv("RETENTION_INTERVAL_SECONDS", "0"))
+
+# Small batches, each in its own short transaction, so live saves are never blocked for long
+RETENTION_BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", "20"))
+RETENTION_BATCH_PAUSE_SECONDS = float(os.getenv("RETENTION_BATCH_PAUSE_SECONDS", "0.2"))
+COMPACTION_PAGES_PER_STEP = int(os.getenv("COMPACTION_PAGES_PER_STEP", "500"))
+
+
+def sessions_beyond_latest(db: Session, keep: int) -> List[int]:
+    """Ids of sessions older than the newest `keep` saves of the same root query."""
+    # Ranked here rather than with a window function so the ranking also spans shards
+    rows = []
+    for _ in shard_scan(db):
+        rows.extend(db.query(GameSession.id, GameSession.original_search_query, GameSession.updated_at))
+    rows.sort(key=lambda row: (row.updated_at or datetime.min, row.id), reverse=True)
+    seen = Counter()
+    beyond = []
+    for row in rows:
+        seen[row.original_search_query] += 1
+        if seen[row.original_search_query] > keep:
+            beyond.append(row.id)
+    return sorted(beyond)
+
+
+def sessions_older_than(db: Session, cutoff: datetime) -> List[int]:
+    ids = []
+    for _ in shard_scan(db):
+        ids.extend(row.id for row in db.query(GameSession.id).filter(GameSession.updated_at < cutoff))
+    return sorted(ids)
+
+
+def archive_session(db: Session, session_id: int) -> Optional[dict]:
+    """Move one session into compressed archive storage. Caller commits.
+
+    The returned `content_hashes` are the blobs the session referenced, for the caller
+    to prune once the deletion is flushed.
+    """
+    game_session = db.get(GameSession, session_id)
+    if game_session is None:
+        return None
+    if db.get(ArchivedSession, session_id) is not None:
+        logger.warning("Session %s already has an archive entry; leaving it live", session_id)
+        return None
+
+    raw = json.dumps(serialize_game_session(db, game_session), ensure_ascii=False).encode("utf-8")
+    compressed = zlib.compress(raw, 9)
+    db.add(ArchivedSession(
+        id=game_session.id,
+        original_search_query=game_session.original_search_query,
+        created_at=game_session.created_at,
+        updated_at=game_session.updated_at,
+        archived_at=datetime.now(timezone.utc),
+        payload=compressed,
+        raw_size=len(raw),
+        compressed_size=len(compressed)
+    ))
+    content_hashes = session_content_hashes(db, game_session.id)
+    db.delete(game_session)
+    return {"raw_size": len(raw), "compressed_size": len(compressed), "content_hashes": content_hashes}
+
+
+def load_archived_session(db: Session, session_id: int) -> Optional[dict]:
+    archived = db.get(ArchivedSession, session_id)
+    if archived is None:
+        return None
+    game_state = json.loads(zlib.decompress(archived.payload).decode("utf-8"))
+    game_state["archived_at"] = archived.archived_at.isoformat()
+    return game_state
+
+
+def apply_retention(
+    session_factory: Callable[[], Session],
+    keep_latest: int = RETENTION_KEEP_LATEST_PER_QUERY,
+    archive_after_days: int = RETENTION_ARCHIVE_AFTER_DAYS,
+) -> dict:
+    """Archive sessions past either policy, pruning the blobs each one leaves unreferenced."""
+    report = {"archived": 0, "raw_bytes": 0, "compressed_bytes": 0, "orphan_blobs_pruned": 0}
+    if not keep_latest and not archive_after_days:
+        return report
+
+    db = session_factory()
+    try:
+        candidates = set()
+        if keep_latest:
+            candidates.update(sessions_beyond_latest(db, keep_latest))
+        if archive_after_days:
+            candidates.update(sessions_older_than(
+                db, datetime.now(timezone.utc) - timedelta(days=archive_after_days)
+            ))
+    finally:
+        db.close()
+
+    ordered = sorted(candidates)
+    for start in range(0, len(ordered), RETENTION_BATCH_SIZE):
+        db = session_factory()
+        try:
+            for session_id in ordered[start:start + RETENTION_BATCH_SIZE]:
+                archived = archive_session(db, session_id)
+                # Written and pruned before the next id can route the session to another shard
+                db.flush()
+                if archived:
+                    report["archived"] += 1
+                    report["raw_bytes"] += archived["raw_size"]
+                    report["compressed_bytes"] += archived["compressed_size"]
+                    report["orphan_blobs_pruned"] += prune_orphan_content(db, archived["content_hashes"])
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+        time.sleep(RETENTION_BATCH_PAUSE_SECONDS)
+    return report
+
+
+def compact(engine) -> dict:
+    """Return free pages to the filesystem a step at a time (SQLite only)."""
+    if engine.dialect.name != "sqlite":
+        return {"skipped": "compaction is only implemented for SQLite"}
+    with engine.connect() as conn:
+        auto_vacuum = conn.execute(text("PRAGMA auto_vacuum")).scalar()
+        free_before = conn.execute(text("PRAGMA freelist_count")).scalar()
+    if auto_vacuum != 2:
+        # Converting requires one full VACUUM: python retention.py vacuum
+        return {"skipped": "auto_vacuum is not INCREMENTAL", "free_pages": free_before}
+
+    previous = free_before
+    while True:
+        with engine.connect() as conn:
+            # sqlite3's execute() steps the pragma once, freeing a single page; executescript runs it to completion
+            conn.connection.driver_connection.executescript(f"PRAGMA incremental_vacuum({COMPACTION_PAGES_PER_STEP})")
+            remaining = conn.execute(text("PRAGMA freelist_count")).scalar()
+        if not remaining or remaining >= previous:
+            # Stop once nothing is left, or when concurrent writes free pages as fast as we reclaim them
+            break
+        previous = remaining
+        time.sleep(RETENTION_BATCH_PAUSE_SECONDS)
+    return {"free_pages_reclaimed": max(free_before - remaining, 0), "free_pages": remaining}
+
+
+def vacuum(engine) -> None:
+    """Full VACUUM; blocks writers, meant for maintenance windows and to enable incremental mode."""
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text("PRAGMA auto_vacuum=INCREMENTAL"))
+        conn.execute(text("VACUUM"))
+
+
+class RetentionScheduler:
+    """Runs retention and compaction on a daemon thread every RETENTION_INTERVAL_SECONDS."""
+
+    def __init__(
+        self,
+        session_factory: Callable[[], Session],
+        engines: Sequence,
+        interval_seconds: int = RETENTION_INTERVAL_SECONDS,
+    ):
+        self.session_factory = session_factory
+        self.engines = list(engines)
+        self.interval_seconds = interval_seconds
+        self.last_report: Optional[dict] = None
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._run_lock = threading.Lock()
+
+    def start(self):
+        if self.interval_seconds <= 0 or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._loop, name="retention", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run_once(self) -> dict:
+        with self._run_lock:
+            started = datetime.now(timezone.utc)
+            report = apply_retention(self.session_factory)
+            report["compaction"] = [compact(engine) for engine in self.engines]
+            report["started_at"] = started.isoformat()
+            report["finished_at"] = datetime.now(timezone.utc).isoformat()
+            self.last_report = report
+            return report
+
+    def _loop(self):
+        while not self._stop_event.wait(self.interval_seconds):
+            try:
+                logger.info("Retention run: %s", self.run_once())
+            except Exception:
+                logger.exception("Retention run failed")
+
+
+if __name__ == "__main__":
+    from models import SessionLocal, create_tables, engines
+
+    parser = argparse.ArgumentParser(description="Archive old sessions and compact the database.")
+    parser.add_argument("command", choices=["run", "compact", "vacuum"])
+    parser.add_argument("--keep-latest", type=int, default=RETENTION_KEEP_LATEST_PER_QUERY)
+    parser.add_argument("--archive-after-days", type=int, default=RETENTION_ARCHIVE_AFTER_DAYS)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    create_tables()
+    if args.command == "run":
+        logger.info("Retention: %s", apply_retention(SessionLocal, args.keep_latest, args.archive_after_days))
+    if args.command in ("run", "compact"):
+        for shard_index, engine in enumerate(engines):
+            logger.info("Compaction (shard %d): %s", shard_index, compact(engine))
+    else:
+        for engine in engines:
+            vacuum(engine)
+        logger.info("VACUUM finished")
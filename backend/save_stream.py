@@ -0,0 +1,507 @@
+import codecs
+import json
+import os
+import re
+import tempfile
+from datetime import datetime, timezone
+from typing import Iterator, List, Optional, Tuple
+
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from content_store import ContentInterner
+from models import GameSession, SearchResult, Branch, Leaf, Flashcard, Fruit, Flower, route_new_session
+from session_transfer import parse_timestamp
+
+# Larger bodies are rejected with 413; checked against Content-Length and while streaming
+MAX_SAVE_BYTES = int(os.getenv("MAX_SAVE_BYTES", str(64 * 1024 * 1024)))
+# Entities buffered before they are written; bounds memory regardless of payload size
+SAVE_BATCH_SIZE = int(os.getenv("SAVE_BATCH_SIZE", "500"))
+# Bodies are spooled in memory up to this size, then to a temporary file
+SAVE_SPOOL_MEMORY_BYTES = int(os.getenv("SAVE_SPOOL_MEMORY_BYTES", str(1024 * 1024)))
+SAVE_READ_CHUNK_BYTES = 64 * 1024
+
+_WHITESPACE = re.compile(r"\s*")
+_STRUCTURAL = re.compile(r'["{}\[\],]')
+_STRING_SPECIAL = re.compile(r'["\\]')
+
+
+class PayloadTooLarge(Exception):
+    pass
+
+
+class InvalidSavePayload(ValueError):
+    """The body is not valid JSON or not shaped like a saved game."""
+
+
+def search_result_row(game_session_id: int, result: dict, snippet_hash: Optional[str], llm_content_hash: Optional[str]) -> dict:
+    return {
+        "game_session_id": game_session_id,
+        "title": result.get("title", ""),
+        "url": result.get("url", ""),
+        "snippet_hash": snippet_hash,
+        "llm_content_hash": llm_content_hash,
+        "search_query": result.get("search_query", ""),
+        "created_at": datetime.now(timezone.utc)
+    }
+
+
+def branch_row(game_session_id: int, branch_data: dict, search_result_id: Optional[int]) -> dict:
+    return {
+        "game_session_id": game_session_id,
+        "search_result_id": search_result_id,
+        "parent_branch_id": branch_data.get("parentBranchId"),  # Track parent
+        "start_x": branch_data.get("start", {}).get("x", 0),
+        "start_y": branch_data.get("start", {}).get("y", 0),
+        "end_x": branch_data.get("end", {}).get("x", 0),
+        "end_y": branch_data.get("end", {}).get("y", 0),
+        "length": branch_data.get("length", 0),
+        "max_length": branch_data.get("maxLength", 0),
+        "angle": branch_data.get("angle", 0),
+        "thickness": branch_data.get("thickness", 1),
+        "generation": branch_data.get("generation", 0),
+        "is_growing": branch_data.get("isGrowing", False),
+        "growth_speed": branch_data.get("growthSpeed", 1.0),
+        "node_type": branch_data.get("nodeType", "branch"),
+        "created_at": datetime.now(timezone.utc)
+    }
+
+
+def leaf_row(game_session_id: int, leaf_data: dict) -> dict:
+    return {
+        "game_session_id": game_session_id,
+        "branch_id": leaf_data.get("branchId"),  # Can be None now
+        "x": leaf_data.get("x", 0),
+        "y": leaf_data.get("y", 0),
+        "size": leaf_data.get("size", 1.0),
+        "created_at": datetime.now(timezone.utc)
+    }
+
+
+def fruit_row(game_session_id: int, fruit_data: dict) -> dict:
+    return {
+        "game_session_id": game_session_id,
+        "x": fruit_data.get("x", 0),
+        "y": fruit_data.get("y", 0),
+        "type": fruit_data.get("type", "apple"),
+        "size": fruit_data.get("size", 1.0),
+        "created_at": datetime.now(timezone.utc)
+    }
+
+
+def flower_row(game_session_id: int, flower_data: dict) -> dict:
+    return {
+        "game_session_id": game_session_id,
+        "x": flower_data.get("x", 0),
+        "y": flower_data.get("y", 0),
+        "type": flower_data.get("type", "🌸"),
+        "size": flower_data.get("size", 1.0),
+        "created_at": datetime.now(timezone.utc)
+    }
+
+
+def flashcard_row(game_session_id: int, flashcard_data: dict) -> dict:
+    # Extract node position if available
+    node_position = flashcard_data.get("node_position") or {}
+    return {
+        "game_session_id": game_session_id,
+        "branch_id": flashcard_data.get("branch_id"),
+        "front": flashcard_data.get("front", ""),
+        "back": flashcard_data.get("back", ""),
+        "difficulty": flashcard_data.get("difficulty", "medium"),
+        "category": flashcard_data.get("category", ""),
+        "node_position_x": node_position.get("x"),
+        "node_position_y": node_position.get("y"),
+        "created_at": datetime.now(timezone.utc),
+        # Carry review progress over from a previously loaded state
+        "last_reviewed": parse_timestamp(flashcard_data.get("last_reviewed")),
+        "review_count": flashcard_data.get("review_count") or 0,
+        "ease_factor": flashcard_data.get("ease_factor") or 2.5,
+        "interval_days": flashcard_data.get("interval_days") or 0.0,
+        "repetitions": flashcard_data.get("repetitions") or 0,
+        "due_at": parse_timestamp(flashcard_data.get("due_at")) or datetime.now(timezone.utc)
+    }
+
+
+class ObjectStreamParser:
+    """Incremental parser for one JSON object whose large members are arrays.
+
+    feed() yields ("value", key, value) for each member that is not an array,
+    ("array", key, None) when an array member opens and ("item", key, item) for
+    each of its elements, as soon as that value is complete. Only the element
+    being parsed is held in memory.
+    """
+
+    # Parser states
+    OBJECT_START, KEY_OR_END, COLON, VALUE, ITEM_OR_END, AFTER_ITEM, AFTER_MEMBER, DONE = range(8)
+
+    def __init__(self):
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
+        self._buffer = ""
+        self._pos = 0
+        self._state = self.OBJECT_START
+        self._key: Optional[str] = None
+        self._first_item = True
+        self._first_member = True
+        # Progress through the value currently being scanned, so no byte is scanned twice
+        self._value_start: Optional[int] = None
+        self._scan_pos = 0
+        self._depth = 0
+        self._in_string = False
+
+    def feed(self, chunk: bytes) -> Iterator[Tuple[str, str, object]]:
+        self._buffer = self._buffer[self._pos:] + self._decode(chunk)
+        if self._value_start is not None:
+            self._scan_pos -= self._pos
+            self._value_start -= self._pos
+        self._pos = 0
+        yield from self._parse()
+
+    def close(self):
+        self._buffer = self._buffer[self._pos:] + self._decode(b"", final=True)
+        self._pos = 0
+        self._skip_whitespace()
+        if self._state != self.DONE or self._pos != len(self._buffer):
+            raise InvalidSavePayload("Request body is not a complete JSON object")
+
+    def _decode(self, chunk: bytes, final: bool = False) -> str:
+        try:
+            return self._decoder.decode(chunk, final)
+        except UnicodeDecodeError as exc:
+            raise InvalidSavePayload(f"Request body is not valid UTF-8: {exc}")
+
+    def _skip_whitespace(self):
+        self._pos = _WHITESPACE.match(self._buffer, self._pos).end()
+
+    def _expect(self, *characters) -> Optional[str]:
+        """The next significant character if it is one of `characters`; None when more input is needed."""
+        self._skip_whitespace()
+        if self._pos >= len(self._buffer):
+            return None
+        character = self._buffer[self._pos]
+        if character not in characters:
+            raise InvalidSavePayload(f"Unexpected {character!r} in request body, expected one of {' '.join(characters)}")
+        self._pos += 1
+        return character
+
+    def _parse(self):
+        while True:
+            state = self._state
+            if state == self.OBJECT_START:
+                if self._expect("{") is None:
+                    return
+                self._state = self.KEY_OR_END
+            elif state == self.KEY_OR_END:
+                self._skip_whitespace()
+                if self._first_member and self._pos < len(self._buffer) and self._buffer[self._pos] == "}":
+                    self._pos += 1
+                    self._state = self.DONE
+                    continue
+                key = self._scan_value()
+                if key is None:
+                    return
+                if not isinstance(key[0], str):
+                    raise InvalidSavePayload("Object keys must be strings")
+                self._key = key[0]
+                self._first_member = False
+                self._state = self.COLON
+            elif state == self.COLON:
+                if self._expect(":") is None:
+                    return
+                self._state = self.VALUE
+            elif state == self.VALUE:
+                self._skip_whitespace()
+                if self._pos >= len(self._buffer):
+                    return
+                if self._buffer[self._pos] == "[":
+                    self._pos += 1
+                    self._first_item = True
+                    self._state = self.ITEM_OR_END
+                    yield ("array", self._key, None)
+                    continue
+                value = self._scan_value()
+                if value is None:
+                    return
+                yield ("value", self._key, value[0])
+                self._state = self.AFTER_MEMBER
+            elif state == self.ITEM_OR_END:
+                self._skip_whitespace()
+                if self._pos >= len(self._buffer):
+                    return
+                if self._first_item and self._buffer[self._pos] == "]":
+                    self._pos += 1
+                    self._state = self.AFTER_MEMBER
+                    continue
+                item = self._scan_value()
+                if item is None:
+                    return
+                self._first_item = False
+                yield ("item", self._key, item[0])
+                self._state = self.AFTER_ITEM
+            elif state == self.AFTER_ITEM:
+                character = self._expect(",", "]")
+                if character is None:
+                    return
+                self._state = self.ITEM_OR_END if character == "," else self.AFTER_MEMBER
+            elif state == self.AFTER_MEMBER:
+                character = self._expect(",", "}")
+                if character is None:
+                    return
+                self._state = self.KEY_OR_END if character == "," else self.DONE
+            else:
+                self._skip_whitespace()
+                if self._pos < len(self._buffer):
+                    raise InvalidSavePayload("Unexpected data after the JSON object")
+                return
+
+    def _scan_value(self):
+        """Parse the JSON value at the cursor; a 1-tuple, or None while it is still incomplete."""
+        if self._value_start is None:
+            self._skip_whitespace()
+            if self._pos >= len(self._buffer):
+                return None
+            self._value_start = self._scan_pos = self._pos
+            self._depth = 0
+            self._in_string = False
+        end = self._find_value_end()
+        if end is None:
+            return None
+        text = self._buffer[self._value_start:end]
+        self._value_start = None
+        self._pos = end
+        try:
+            return (json.loads(text),)
+        except json.JSONDecodeError as exc:
+            raise InvalidSavePayload(f"Invalid JSON in request body: {exc}")
+
+    def _find_value_end(self) -> Optional[int]:
+        buffer, pos = self._buffer, self._scan_pos
+        while True:
+            if self._in_string:
+                match = _STRING_SPECIAL.search(buffer, pos)
+                if match is None:
+                    self._scan_pos = len(buffer)
+                    return None
+                if match.group() == "\\":
+                    if match.end() >= len(buffer):
+                        self._scan_pos = match.start()
+                        return None
+                    pos = match.end() + 1
+                    continue
+                self._in_string = False
+                pos = match.end()
+                if self._depth == 0:
+                    return pos
+                continue
+            match = _STRUCTURAL.search(buffer, pos)
+            if match is None:
+                self._scan_pos = len(buffer)
+                return None
+            character = match.group()
+            if character == '"':
+                self._in_string = True
+                pos = match.end()
+            elif character in "{[":
+                self._depth += 1
+                pos = match.end()
+            elif character in "}]":
+                if self._depth == 0:
+                    # A bare number/true/false/null ends at the enclosing container's close
+                    return match.start()
+                self._depth -= 1
+                pos = match.end()
+                if self._depth == 0:
+                    return pos
+            elif self._depth == 0:
+                return match.start()
+            else:
+                pos = match.end()
+
+
+class StreamingSave:
+    """Writes one saved game as its entities arrive, in batches of SAVE_BATCH_SIZE.
+
+    Only ids of top-level search results are kept across batches. The save is a
+    single transaction, opened by the first batch: the caller commits after
+    finish() or rolls back on error. Shape errors raise InvalidSavePayload,
+    mirroring SaveGameStateRequest.
+
+    Given an existing `game_session`, the entities are appended to it instead:
+    no field is required and only a camera offset that is sent is applied.
+    """
+
+    ARRAY_KEYS = ("search_results", "branches", "leaves", "fruits", "flowers", "flashcards")
+    REQUIRED_ARRAYS = ("search_results", "branches", "leaves", "fruits", "flowers")
+
+    def __init__(self, db: Session, batch_size: int = SAVE_BATCH_SIZE, game_session: Optional[GameSession] = None):
+        self.db = db
+        self.batch_size = batch_size
+        self.values = {}
+        self.arrays = set()
+        self.counts = {key: 0 for key in self.ARRAY_KEYS}
+        self._pending = {key: [] for key in self.ARRAY_KEYS}
+        self._buffered = 0
+        # Ids of the top-level search results, in order, for the index-based branch fallback
+        self._result_ids: List[int] = []
+        # (branch id, index) pairs whose fallback result had not arrived yet
+        self._unresolved_branches: List[Tuple[int, int]] = []
+        self.game_session = game_session
+        self.game_session_id: Optional[int] = game_session.id if game_session is not None else None
+        self._appending = game_session is not None
+
+    def _start(self):
+        # Deferred to the first write, so a body rejected early never touches the database
+        if self.game_session is not None:
+            return
+        route_new_session(self.db)
+        now = datetime.now(timezone.utc)
+        # The query and camera offset are filled in by finish(); they may follow the arrays
+        self.game_session = GameSession(original_search_query="", created_at=now, updated_at=now)
+        self.db.add(self.game_session)
+        self.db.flush()  # Get the ID
+        self.game_session_id = self.game_session.id
+
+    def add(self, event: str, key: str, value):
+        if event == "array":
+            self.arrays.add(key)
+            return
+        if event == "value":
+            if key in self.ARRAY_KEYS:
+                raise InvalidSavePayload(f"{key} must be a list")
+            if key == "original_search_query" and not isinstance(value, str):
+                raise InvalidSavePayload("original_search_query must be a string")
+            if key == "camera_offset" and not isinstance(value, dict):
+                raise InvalidSavePayload("camera_offset must be an object")
+            self.values[key] = value
+            return
+        if key not in self._pending:
+            return
+        if not isinstance(value, dict):
+            raise InvalidSavePayload(f"Items of {key} must be objects")
+        self._pending[key].append(value)
+        self.counts[key] += 1
+        self._buffered += 1
+        if self._buffered >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        self._start()
+        pending, self._pending = self._pending, {key: [] for key in self.ARRAY_KEYS}
+        self._buffered = 0
+        session_id = self.game_session_id
+        db = self.db
+
+        interner = ContentInterner(db)
+        # Search results first so branches in the same batch can use the index fallback
+        result_rows = [
+            search_result_row(session_id, result, interner.add(result.get("snippet", "")), interner.add(result.get("llm_content", "")))
+            for result in pending["search_results"]
+        ]
+        branch_result_rows = [
+            search_result_row(session_id, branch_data["searchResult"],
+                              interner.add(branch_data["searchResult"].get("snippet", "")),
+                              interner.add(branch_data["searchResult"].get("llm_content", "")))
+            for branch_data in pending["branches"] if branch_data.get("searchResult")
+        ]
+        interner.flush()
+        if result_rows:
+            db.bulk_insert_mappings(SearchResult, result_rows, return_defaults=True)
+            self._result_ids.extend(row["id"] for row in result_rows)
+        if branch_result_rows:
+            db.bulk_insert_mappings(SearchResult, branch_result_rows, return_defaults=True)
+
+        branch_rows = []
+        fallback_indexes = []
+        own_results = iter(branch_result_rows)
+        first_index = self.counts["branches"] - len(pending["branches"])
+        for index, branch_data in enumerate(pending["branches"], start=first_index):
+            search_result_id = None
+            if branch_data.get("searchResult"):
+                search_result_id = next(own_results)["id"]
+            elif index < len(self._result_ids):
+                # Fallback to index-based matching for initial branches
+                search_result_id = self._result_ids[index]
+            else:
+                fallback_indexes.append((len(branch_rows), index))
+            branch_rows.append(branch_row(session_id, branch_data, search_result_id))
+        if branch_rows:
+            db.bulk_insert_mappings(Branch, branch_rows, return_defaults=bool(fallback_indexes))
+            self._unresolved_branches.extend(
+                (branch_rows[position]["id"], index) for position, index in fallback_indexes
+            )
+
+        for model, build_row, key in (
+            (Leaf, leaf_row, "leaves"),
+            (Fruit, fruit_row, "fruits"),
+            (Flower, flower_row, "flowers"),
+            (Flashcard, flashcard_row, "flashcards"),
+        ):
+            if pending[key]:
+                db.bulk_insert_mappings(model, [build_row(session_id, item) for item in pending[key]])
+
+    def finish(self) -> int:
+        if not self._appending:
+            missing = [key for key in self.REQUIRED_ARRAYS if key not in self.arrays]
+            if "original_search_query" not in self.values:
+                missing.insert(0, "original_search_query")
+            if missing:
+                raise InvalidSavePayload(f"Missing required fields: {', '.join(missing)}")
+        self.flush()
+        # Branches that arrived before the search results they fall back to
+        updates = [
+            {"id": branch_id, "search_result_id": self._result_ids[index]}
+            for branch_id, index in self._unresolved_branches if index < len(self._result_ids)
+        ]
+        if updates:
+            self.db.bulk_update_mappings(Branch, updates)
+        game_session = self.game_session
+        camera_offset = self.values.get("camera_offset") or {}
+        if self._appending:
+            game_session.camera_offset_x = camera_offset.get("x", game_session.camera_offset_x)
+            game_session.camera_offset_y = camera_offset.get("y", game_session.camera_offset_y)
+            game_session.updated_at = datetime.now(timezone.utc)
+        else:
+            game_session.original_search_query = self.values["original_search_query"]
+            game_session.camera_offset_x = camera_offset.get("x", 0.0)
+            game_session.camera_offset_y = camera_offset.get("y", 0.0)
+        self.db.flush()
+        return self.game_session_id
+
+
+async def spool_save_body(chunks, content_length: Optional[int] = None, max_bytes: int = MAX_SAVE_BYTES):
+    """Buffer a save body, in memory while small and in a temporary file beyond that.
+
+    Nothing is written to the database while the upload is still arriving, so a
+    slow client never holds a write lock. The caller closes the returned file.
+    """
+    if content_length is not None and content_length > max_bytes:
+        raise PayloadTooLarge(f"Save payload exceeds {max_bytes} bytes")
+    spool = tempfile.SpooledTemporaryFile(max_size=SAVE_SPOOL_MEMORY_BYTES)
+    received = 0
+    try:
+        async for chunk in chunks:
+            received += len(chunk)
+            if received > max_bytes:
+                raise PayloadTooLarge(f"Save payload exceeds {max_bytes} bytes")
+            if getattr(spool, "_rolled", True):
+                # Disk writes go to the threadpool, as UploadFile does
+                await run_in_threadpool(spool.write, chunk)
+            else:
+                spool.write(chunk)
+    except BaseException:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool
+
+
+def ingest_save(db: Session, body, chunk_size: int = SAVE_READ_CHUNK_BYTES) -> StreamingSave:
+    """Parse a complete save body from a binary file and write it in batches. Caller commits."""
+    parser = ObjectStreamParser()
+    save = StreamingSave(db)
+    for chunk in iter(lambda: body.read(chunk_size), b""):
+        for event, key, value in parser.feed(chunk):
+            save.add(event, key, value)
+    parser.close()
+    save.finish()
+    return save
@@ -0,0 +1,120 @@
+"""Peak memory of buffered vs streaming saves for very large trees.
+
+    python save_stream_benchmark.py --branches 10000 50000 200000
+
+"buffered" parses the whole body with json.loads before writing, as the
+pydantic-bound endpoint did (pydantic's own copies come on top of that);
+"streaming" spools 64 KB chunks with spool_save_body and writes them with
+ingest_save, as /api/save-game-state now runs. Peaks are Python allocations
+measured with tracemalloc.
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+# Keep the default database untouched
+_scratch_dir = tempfile.mkdtemp(prefix="perplexitree-save-bench-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_scratch_dir, 'bench.db')}"
+os.environ.setdefault("MAX_SAVE_BYTES", str(4 * 1024 ** 3))
+
+from models import SessionLocal, create_tables  # noqa: E402
+from save_stream import StreamingSave, ingest_save, spool_save_body  # noqa: E402
+
+CHUNK_SIZE = 64 * 1024
+
+
+def synthetic_body(branches: int, text_bytes: int) -> bytes:
+    filler = "x" * text_bytes
+
+    def items():
+        for index in range(branches):
+            yield json.dumps({
+                "id": index,
+                "parentBranchId": index - 1 if index else None,
+                "searchResult": {
+                    "title": f"Result {index}",
+                    "url": f"https://example.com/{index}",
+                    "snippet": f"{index} {filler}",
+                    "llm_content": f"{filler} {index}",
+                },
+                "start": {"x": 0, "y": 0},
+                "end": {"x": index, "y": index},
+                "generation": index % 7,
+            })
+
+    leaves = ",".join(json.dumps({"branchId": index, "x": index, "y": 1}) for index in range(branches))
+    return (
+        '{"original_search_query": "benchmark", "search_results": [], "branches": ['
+        + ",".join(items())
+        + '], "leaves": [' + leaves + '], "fruits": [], "flowers": [], "flashcards": []}'
+    ).encode("utf-8")
+
+
+def buffered_save(body: bytes):
+    payload = json.loads(body)
+    db = SessionLocal()
+    try:
+        save = StreamingSave(db, batch_size=10 ** 9)
+        for key, value in payload.items():
+            if isinstance(value, list):
+                save.add("array", key, None)
+                for item in value:
+                    save.add("item", key, item)
+            else:
+                save.add("value", key, value)
+        save.finish()
+        db.commit()
+    finally:
+        db.close()
+
+
+def streaming_save(body: bytes):
+    async def chunks():
+        for start in range(0, len(body), CHUNK_SIZE):
+            yield body[start:start + CHUNK_SIZE]
+
+    spool = asyncio.run(spool_save_body(chunks(), len(body)))
+    db = SessionLocal()
+    try:
+        ingest_save(db, spool)
+        db.commit()
+    finally:
+        db.close()
+        spool.close()
+
+
+def measure(label: str, save, body: bytes) -> dict:
+    # Started after the body is built, so only what saving allocates is counted
+    tracemalloc.start()
+    started = time.perf_counter()
+    save(body)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"path": label, "peak_mb": round(peak / 1024 ** 2, 1), "seconds": round(elapsed, 2)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare peak memory of buffered and streaming saves.")
+    parser.add_argument("--branches", type=int, nargs="+", default=[10000, 50000, 200000])
+    parser.add_argument("--text-bytes", type=int, default=1000, help="Snippet/content size per branch result")
+    args = parser.parse_args()
+
+    try:
+        create_tables()
+        print(f"{'branches':>9} {'body MB':>8} {'path':>10} {'peak MB':>8} {'seconds':>8}")
+        for branch_count in args.branches:
+            body = synthetic_body(branch_count, args.text_bytes)
+            for label, save in (("buffered", buffered_save), ("streaming", streaming_save)):
+                result = measure(label, save, body)
+                print(
+                    f"{branch_count:>9} {len(body) / 1024 ** 2:>8.1f} {result['path']:>10} "
+                    f"{result['peak_mb']:>8} {result['seconds']:>8}"
+                )
+    finally:
+        shutil.rmtree(_scratch_dir, ignore_errors=True)
@@ -0,0 +1,418 @@
+import argparse
+import json
+import logging
+import os
+import sys
+from datetime import datetime, timezone
+from typing import Iterable, Iterator, Optional
+
+from sqlalchemy.orm import Session
+
+from content_store import ContentInterner
+from models import (
+    ArchivedSession, GameSession, SearchResult, Branch, Leaf, Flashcard, Fruit, Flower, route_new_session, shard_scan
+)
+
+logger = logging.getLogger(__name__)
+
+EXPORT_BATCH_SIZE = 100  # Sessions fetched per server-side cursor round trip
+IMPORT_BATCH_SIZE = 5000  # Entities written before each commit
+# Larger /api/import-sessions bodies are rejected with 413
+MAX_IMPORT_BYTES = int(os.getenv("MAX_IMPORT_BYTES", str(512 * 1024 * 1024)))
+
+
+def _isoformat(value: Optional[datetime]) -> Optional[str]:
+    return value.isoformat() if value else None
+
+
+def parse_timestamp(value) -> Optional[datetime]:
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def serialize_game_session(db: Session, game_session: GameSession) -> dict:
+    """Build the load-game-state payload for one session."""
+    session_id = game_session.id
+    search_results = db.query(SearchResult).filter(SearchResult.game_session_id == session_id).all()
+    branches = db.query(Branch).filter(Branch.game_session_id == session_id).all()
+    leaves = db.query(Leaf).filter(Leaf.game_session_id == session_id).all()
+    flashcards = db.query(Flashcard).filter(Flashcard.game_session_id == session_id).all()
+    fruits = db.query(Fruit).filter(Fruit.game_session_id == session_id).all()
+    flowers = db.query(Flower).filter(Flower.game_session_id == session_id).all()
+
+    # Branches resolve their search result from this map instead of one lazy load each
+    search_results_by_id = {result.id: result for result in search_results}
+
+    search_results_data = []
+    for result in search_results:
+        search_results_data.append({
+            "id": result.id,
+            "title": result.title,
+            "url": result.url,
+            "snippet": result.snippet,
+            "llm_content": result.llm_content,
+            "search_query": result.search_query
+        })
+
+    branches_data = []
+    for branch in branches:
+        search_result = None
+        if branch.search_result_id is not None:
+            search_result = search_results_by_id.get(branch.search_result_id) or branch.search_result
+        branches_data.append({
+            "id": branch.id,
+            "start": {"x": branch.start_x, "y": branch.start_y},
+            "end": {"x": branch.end_x, "y": branch.end_y},
+            "length": branch.length,
+            "maxLength": branch.max_length,
+            "angle": branch.angle,
+            "thickness": branch.thickness,
+            "generation": branch.generation,
+            "isGrowing": branch.is_growing,
+            "growthSpeed": branch.growth_speed,
+            "nodeType": branch.node_type,
+            "parentBranchId": branch.parent_branch_id,
+            "searchResult": {
+                "id": search_result.id,
+                "title": search_result.title,
+                "url": search_result.url,
+                "snippet": search_result.snippet,
+                "llm_content": search_result.llm_content
+            } if search_result else None
+        })
+
+    leaves_data = []
+    for leaf in leaves:
+        leaves_data.append({
+            "id": leaf.id,
+            "x": leaf.x,
+            "y": leaf.y,
+            "size": leaf.size,
+            "branchId": leaf.branch_id
+        })
+
+    fruits_data = []
+    for fruit in fruits:
+        fruits_data.append({
+            "id": fruit.id,
+            "x": fruit.x,
+            "y": fruit.y,
+            "type": fruit.type,
+            "size": fruit.size
+        })
+
+    flowers_data = []
+    for flower in flowers:
+        flowers_data.append({
+            "id": flower.id,
+            "x": flower.x,
+            "y": flower.y,
+            "type": flower.type,
+            "size": flower.size
+        })
+
+    flashcards_data = []
+    for flashcard in flashcards:
+        flashcards_data.append({
+            "id": flashcard.id,
+            "branch_id": flashcard.branch_id,
+            "front": flashcard.front,
+            "back": flashcard.back,
+            "difficulty": flashcard.difficulty,
+            "category": flashcard.category,
+            "node_position": {
+                "x": flashcard.node_position_x,
+                "y": flashcard.node_position_y
+            } if flashcard.node_position_x is not None and flashcard.node_position_y is not None else None,
+            "created_at": flashcard.created_at.isoformat(),
+            "last_reviewed": _isoformat(flashcard.last_reviewed),
+            "review_count": flashcard.review_count,
+            "ease_factor": flashcard.ease_factor,
+            "interval_days": flashcard.interval_days,
+            "repetitions": flashcard.repetitions,
+            "due_at": _isoformat(flashcard.due_at)
+        })
+
+    return {
+        "original_search_query": game_session.original_search_query,
+        "search_results": search_results_data,
+        "branches": branches_data,
+        "leaves": leaves_data,
+        "flashcards": flashcards_data,
+        "fruits": fruits_data,
+        "flowers": flowers_data,
+        "camera_offset": {"x": game_session.camera_offset_x, "y": game_session.camera_offset_y},
+        "created_at": game_session.created_at.isoformat(),
+        "updated_at": game_session.updated_at.isoformat()
+    }
+
+
+def export_sessions_ndjson(db: Session, batch_size: int = EXPORT_BATCH_SIZE) -> Iterator[str]:
+    """Yield one NDJSON line per session, holding at most one session in memory.
+
+    Archived sessions follow the live ones, decompressed, with their id and archived_at.
+    """
+    # retention imports this module
+    from retention import load_archived_session
+
+    exported = 0
+    # Shard id ranges ascend with the shard index, so the output stays ordered by id
+    for _ in shard_scan(db):
+        session_ids = (
+            db.query(GameSession.id)
+            .order_by(GameSession.id)
+            .execution_options(stream_results=True)
+            .yield_per(batch_size)
+        )
+        for (session_id,) in session_ids:
+            game_session = db.get(GameSession, session_id)
+            if game_session is None:
+                continue
+            record = serialize_game_session(db, game_session)
+            record["id"] = session_id
+            yield json.dumps(record, ensure_ascii=False) + "\n"
+            exported += 1
+            # Drop loaded rows so the identity map does not grow with the export
+            if exported % batch_size == 0:
+                db.expunge_all()
+
+    for _ in shard_scan(db):
+        archived_ids = (
+            db.query(ArchivedSession.id)
+            .order_by(ArchivedSession.id)
+            .execution_options(stream_results=True)
+            .yield_per(batch_size)
+        )
+        for (session_id,) in archived_ids:
+            record = load_archived_session(db, session_id)
+            if record is None:
+                continue
+            record["id"] = session_id
+            yield json.dumps(record, ensure_ascii=False) + "\n"
+            exported += 1
+            if exported % batch_size == 0:
+                db.expunge_all()
+
+
+class SessionImporter:
+    """Writes exported sessions back with batched inserts and remapped ids."""
+
+    def __init__(self, db: Session, batch_size: int = IMPORT_BATCH_SIZE):
+        self.db = db
+        self.batch_size = batch_size
+        self.sessions_imported = 0
+        self.entities_imported = 0
+        # What earlier batches actually stored; a failed batch rolls back only its own sessions
+        self.sessions_committed = 0
+        self.entities_committed = 0
+        self._uncommitted = 0
+
+    def import_line(self, line) -> Optional[int]:
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+        line = line.strip()
+        if not line:
+            return None
+        return self.import_session(json.loads(line))
+
+    def import_lines(self, lines: Iterable) -> dict:
+        for line in lines:
+            self.import_line(line)
+        return self.finish()
+
+    def import_session(self, record: dict) -> int:
+        db = self.db
+        now = datetime.now(timezone.utc)
+        camera_offset = record.get("camera_offset") or {}
+        game_session = GameSession(
+            original_search_query=record.get("original_search_query", ""),
+            camera_offset_x=camera_offset.get("x", 0.0),
+            camera_offset_y=camera_offset.get("y", 0.0),
+            created_at=parse_timestamp(record.get("created_at")) or now,
+            updated_at=parse_timestamp(record.get("updated_at")) or now
+        )
+        route_new_session(db)
+        db.add(game_session)
+        db.flush()
+        session_id = game_session.id
+
+        # Search results referenced only from a branch still need a row
+        search_results = list(record.get("search_results", []))
+        known_result_ids = {result.get("id") for result in search_results}
+        for branch_data in record.get("branches", []):
+            branch_result = branch_data.get("searchResult")
+            if branch_result and branch_result.get("id") not in known_result_ids:
+                search_results.append(branch_result)
+                known_result_ids.add(branch_result.get("id"))
+
+        interner = ContentInterner(db)
+        search_result_rows = []
+        for result in search_results:
+            search_result_rows.append({
+                "game_session_id": session_id,
+                "title": result.get("title") or "",
+                "url": result.get("url", ""),
+                "snippet_hash": interner.add(result.get("snippet")),
+                "llm_content_hash": interner.add(result.get("llm_content")),
+                "search_query": result.get("search_query", ""),
+                "created_at": now
+            })
+        interner.flush()
+        db.bulk_insert_mappings(SearchResult, search_result_rows, return_defaults=True)
+        search_result_ids = {
+            result.get("id"): row["id"] for result, row in zip(search_results, search_result_rows)
+        }
+
+        branches = record.get("branches", [])
+        branch_rows = []
+        for branch_data in branches:
+            branch_result = branch_data.get("searchResult") or {}
+            branch_rows.append({
+                "game_session_id": session_id,
+                "search_result_id": search_result_ids.get(branch_result.get("id")),
+                "start_x": branch_data.get("start", {}).get("x", 0),
+                "start_y": branch_data.get("start", {}).get("y", 0),
+                "end_x": branch_data.get("end", {}).get("x", 0),
+                "end_y": branch_data.get("end", {}).get("y", 0),
+                "length": branch_data.get("length", 0),
+                "max_length": branch_data.get("maxLength", 0),
+                "angle": branch_data.get("angle", 0),
+                "thickness": branch_data.get("thickness", 1),
+                "generation": branch_data.get("generation", 0),
+                "is_growing": branch_data.get("isGrowing", False),
+                "growth_speed": branch_data.get("growthSpeed", 1.0),
+                "node_type": branch_data.get("nodeType", "branch"),
+                "created_at": now
+            })
+        db.bulk_insert_mappings(Branch, branch_rows, return_defaults=True)
+        branch_ids = {
+            branch_data.get("id"): row["id"] for branch_data, row in zip(branches, branch_rows)
+        }
+
+        # Parents can only be linked once every branch in the session has its new id
+        parent_updates = []
+        for branch_data, row in zip(branches, branch_rows):
+            parent_id = branch_ids.get(branch_data.get("parentBranchId"))
+            if parent_id is not None:
+                parent_updates.append({"id": row["id"], "parent_branch_id": parent_id})
+        if parent_updates:
+            db.bulk_update_mappings(Branch, parent_updates)
+
+        leaf_rows = [{
+            "game_session_id": session_id,
+            "branch_id": branch_ids.get(leaf_data.get("branchId")),
+            "x": leaf_data.get("x", 0),
+            "y": leaf_data.get("y", 0),
+            "size": leaf_data.get("size", 1.0),
+            "created_at": now
+        } for leaf_data in record.get("leaves", [])]
+
+        fruit_rows = [{
+            "game_session_id": session_id,
+            "x": fruit_data.get("x", 0),
+            "y": fruit_data.get("y", 0),
+            "type": fruit_data.get("type", "apple"),
+            "size": fruit_data.get("size", 1.0),
+            "created_at": now
+        } for fruit_data in record.get("fruits", [])]
+
+        flower_rows = [{
+            "game_session_id": session_id,
+            "x": flower_data.get("x", 0),
+            "y": flower_data.get("y", 0),
+            "type": flower_data.get("type", "🌸"),
+            "size": flower_data.get("size", 1.0),
+            "created_at": now
+        } for flower_data in record.get("flowers", [])]
+
+        flashcard_rows = []
+        for flashcard_data in record.get("flashcards", []):
+            node_position = flashcard_data.get("node_position") or {}
+            created_at = parse_timestamp(flashcard_data.get("created_at")) or now
+            flashcard_rows.append({
+                "game_session_id": session_id,
+                "branch_id": branch_ids.get(flashcard_data.get("branch_id")),
+                "front": flashcard_data.get("front", ""),
+                "back": flashcard_data.get("back", ""),
+                "difficulty": flashcard_data.get("difficulty", "medium"),
+                "category": flashcard_data.get("category", ""),
+                "node_position_x": node_position.get("x"),
+                "node_position_y": node_position.get("y"),
+                "created_at": created_at,
+                "last_reviewed": parse_timestamp(flashcard_data.get("last_reviewed")),
+                "review_count": flashcard_data.get("review_count") or 0,
+                "ease_factor": flashcard_data.get("ease_factor") or 2.5,
+                "interval_days": flashcard_data.get("interval_days") or 0.0,
+                "repetitions": flashcard_data.get("repetitions") or 0,
+                "due_at": parse_timestamp(flashcard_data.get("due_at")) or created_at
+            })
+
+        db.bulk_insert_mappings(Leaf, leaf_rows)
+        db.bulk_insert_mappings(Fruit, fruit_rows)
+        db.bulk_insert_mappings(Flower, flower_rows)
+        db.bulk_insert_mappings(Flashcard, flashcard_rows)
+
+        entity_count = 1 + sum(map(len, (
+            search_result_rows, branch_rows, leaf_rows, fruit_rows, flower_rows, flashcard_rows
+        )))
+        self.sessions_imported += 1
+        self.entities_imported += entity_count
+        self._uncommitted += entity_count
+        if self._uncommitted >= self.batch_size:
+            self._commit()
+        return session_id
+
+    def _commit(self):
+        self.db.commit()
+        self.db.expunge_all()
+        self.sessions_committed = self.sessions_imported
+        self.entities_committed = self.entities_imported
+        self._uncommitted = 0
+
+    def finish(self) -> dict:
+        self._commit()
+        return {"sessions_imported": self.sessions_imported, "entities_imported": self.entities_imported}
+
+
+if __name__ == "__main__":
+    from models import SessionLocal, create_tables
+
+    parser = argparse.ArgumentParser(description="Export or import game sessions as NDJSON.")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    export_parser = subcommands.add_parser("export", help="Write every session to stdout or a file")
+    export_parser.add_argument("path", nargs="?", help="Output file (default: stdout)")
+    import_parser = subcommands.add_parser("import", help="Read sessions from stdin or a file")
+    import_parser.add_argument("path", nargs="?", help="Input file (default: stdin)")
+    import_parser.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    create_tables()
+    db_session = SessionLocal()
+    try:
+        if args.command == "export":
+            output = open(args.path, "w", encoding="utf-8") if args.path else sys.stdout
+            try:
+                for line in export_sessions_ndjson(db_session):
+                    output.write(line)
+            finally:
+                if args.path:
+                    output.close()
+        else:
+            source = open(args.path, encoding="utf-8") if args.path else sys.stdin
+            try:
+                summary = SessionImporter(db_session, batch_size=args.batch_size).import_lines(source)
+            except Exception:
+                db_session.rollback()
+                logger.error("Import stopped; sessions committed before the failure are kept")
+                raise
+            finally:
+                if args.path:
+                    source.close()
+            logger.info("Import finished: %s", summary)
+    finally:
+        db_session.close()
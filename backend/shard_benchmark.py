@@ -0,0 +1,151 @@
+"""Concurrent save throughput against 1..N SQLite shards.
+
+    python shard_benchmark.py --shards 1 2 4 --writers 8 --saves 25
+
+Every writer is a separate process, like a uvicorn worker, with its own shard
+router, saving whole sessions through the same batched import path the API
+uses. With one file the writers queue on its write lock; with several they
+commit side by side. Threads would mostly measure the GIL instead.
+"""
+import argparse
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+# Keep the default database untouched; the benchmark builds its own shards below
+_scratch_dir = tempfile.mkdtemp(prefix="perplexitree-bench-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_scratch_dir, 'unused.db')}"
+# SQLite's busy handler is not fair; with more writers than cores a waiter can exceed the default 5 s
+os.environ.setdefault("SQLITE_BUSY_TIMEOUT_MS", "120000")
+
+from models import ShardRouter, create_tables  # noqa: E402
+from session_transfer import SessionImporter  # noqa: E402
+
+
+def synthetic_session(index: int, branches: int, text_bytes: int) -> dict:
+    """A session shaped like a save from the frontend, with unique content per branch."""
+    filler = "x" * text_bytes
+    results = [{
+        "id": branch,
+        "title": f"Result {branch}",
+        "url": f"https://example.com/{index}/{branch}",
+        "snippet": f"{index}-{branch} {filler}",
+        "llm_content": f"{branch}-{index} {filler}",
+        "search_query": f"benchmark {index}",
+    } for branch in range(branches)]
+    return {
+        "original_search_query": f"benchmark {index}",
+        "search_results": results,
+        "branches": [{
+            "id": branch,
+            "parentBranchId": branch - 1 if branch else None,
+            "searchResult": results[branch],
+            "start": {"x": 0, "y": 0},
+            "end": {"x": branch, "y": branch},
+            "length": 10,
+            "maxLength": 10,
+            "generation": branch % 5,
+        } for branch in range(branches)],
+        "leaves": [{"branchId": branch, "x": branch, "y": 0} for branch in range(branches)],
+        "flashcards": [{
+            "branch_id": branch, "front": f"Q{branch}", "back": f"A{branch}", "category": "bench"
+        } for branch in range(branches)],
+    }
+
+
+def _writer(database_url, shards, worker, writers, saves, branches, text_bytes, start_barrier, results):
+    # Each process opens its own engines; placement starts at its own shard, as pid offsets do for workers
+    router = ShardRouter(database_url, shards, first_shard=worker)
+    session_factory = router.sessionmaker()
+    records = [
+        synthetic_session(index, branches, text_bytes)
+        for index in range(worker, writers * saves, writers)
+    ]
+    latencies = []
+    start_barrier.wait()
+    started = time.monotonic()
+    try:
+        for record in records:
+            db = session_factory()
+            save_started = time.monotonic()
+            try:
+                # One transaction per save, as /api/save-game-state does
+                importer = SessionImporter(db, batch_size=10 ** 9)
+                importer.import_session(record)
+                importer.finish()
+            finally:
+                db.close()
+            latencies.append(time.monotonic() - save_started)
+    except Exception as exc:
+        # Always report back, or the parent would wait for this worker forever
+        results.put(f"writer {worker}: {exc}")
+        raise
+    finally:
+        for engine in router.engines:
+            engine.dispose()
+    results.put((started, time.monotonic(), latencies))
+
+
+def run(shards: int, writers: int, saves: int, branches: int, text_bytes: int) -> dict:
+    directory = tempfile.mkdtemp(dir=_scratch_dir)
+    database_url = f"sqlite:///{os.path.join(directory, 'bench.db')}"
+    router = ShardRouter(database_url, shards)
+    create_tables(router.engines)
+    for engine in router.engines:
+        engine.dispose()
+
+    start_barrier = multiprocessing.Barrier(writers)
+    results = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(
+            target=_writer,
+            args=(database_url, shards, worker, writers, saves, branches, text_bytes, start_barrier, results)
+        )
+        for worker in range(writers)
+    ]
+    for process in processes:
+        process.start()
+    reports = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    failures = [report for report in reports if isinstance(report, str)]
+    if failures:
+        raise RuntimeError("; ".join(failures))
+
+    # time.monotonic() is system-wide, so start and end times compare across processes
+    elapsed = max(finished for _, finished, _ in reports) - min(started for started, _, _ in reports)
+    latencies = sorted(latency for _, _, worker_latencies in reports for latency in worker_latencies)
+    return {
+        "shards": shards,
+        "saves": len(latencies),
+        "seconds": round(elapsed, 3),
+        "saves_per_second": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 1),
+        "p95_ms": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000, 1),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure concurrent save throughput by shard count.")
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--writers", type=int, default=8, help="Concurrent writer processes")
+    parser.add_argument("--saves", type=int, default=20, help="Saves per writer")
+    parser.add_argument("--branches", type=int, default=200, help="Branches (and results, leaves, cards) per save")
+    parser.add_argument("--text-bytes", type=int, default=2000, help="Snippet/content size per search result")
+    args = parser.parse_args()
+
+    try:
+        baseline = None
+        print(f"{os.cpu_count()} CPUs, {args.writers} writer processes")
+        print(f"{'shards':>6} {'saves/s':>9} {'speedup':>8} {'p50 ms':>8} {'p95 ms':>8}")
+        for shard_count in args.shards:
+            result = run(shard_count, args.writers, args.saves, args.branches, args.text_bytes)
+            baseline = baseline or result["saves_per_second"]
+            print(
+                f"{result['shards']:>6} {result['saves_per_second']:>9} "
+                f"{result['saves_per_second'] / baseline:>7.2f}x {result['p50_ms']:>8} {result['p95_ms']:>8}"
+            )
+    finally:
+        shutil.rmtree(_scratch_dir, ignore_errors=True)
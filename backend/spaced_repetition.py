@@ -0,0 +1,57 @@
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+# SM-2 constants (Wozniak, 1990)
+MIN_EASE_FACTOR = 1.3
+DEFAULT_EASE_FACTOR = 2.5
+PASSING_GRADE = 3
+MAX_GRADE = 5
+
+
+@dataclass
+class ReviewSchedule:
+    ease_factor: float
+    interval_days: float
+    repetitions: int
+    due_at: datetime
+
+
+def next_review(
+    grade: int,
+    ease_factor: Optional[float] = None,
+    interval_days: Optional[float] = None,
+    repetitions: Optional[int] = None,
+    now: Optional[datetime] = None,
+) -> ReviewSchedule:
+    """Apply one SM-2 review with a 0-5 recall grade and return the new schedule."""
+    if grade < 0 or grade > MAX_GRADE:
+        raise ValueError(f"grade must be between 0 and {MAX_GRADE}")
+
+    ease_factor = ease_factor or DEFAULT_EASE_FACTOR
+    interval_days = interval_days or 0.0
+    repetitions = repetitions or 0
+    now = now or datetime.now(timezone.utc)
+
+    if grade < PASSING_GRADE:
+        # Failed recall restarts the repetition sequence
+        repetitions = 0
+        interval_days = 1.0
+    else:
+        if repetitions == 0:
+            interval_days = 1.0
+        elif repetitions == 1:
+            interval_days = 6.0
+        else:
+            interval_days = round(interval_days * ease_factor, 2)
+        repetitions += 1
+
+    ease_factor += 0.1 - (MAX_GRADE - grade) * (0.08 + (MAX_GRADE - grade) * 0.02)
+    ease_factor = max(MIN_EASE_FACTOR, round(ease_factor, 4))
+
+    return ReviewSchedule(
+        ease_factor=ease_factor,
+        interval_days=interval_days,
+        repetitions=repetitions,
+        due_at=now + timedelta(days=interval_days),
+    )
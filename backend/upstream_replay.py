@@ -0,0 +1,244 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Optional
+
+from sqlalchemy import func
+
+from profiling import span
+
+logger = logging.getLogger(__name__)
+
+# live:   always call upstream, never record
+# record: call upstream and record every response
+# replay: serve only from recordings (offline, deterministic benchmarking)
+# auto:   record, and fall back to recordings when upstream is failing or slow
+UPSTREAM_MODES = ("live", "record", "replay", "auto")
+UPSTREAM_MODE = os.getenv("UPSTREAM_MODE", "auto").lower()
+
+UPSTREAM_WINDOW = int(os.getenv("UPSTREAM_WINDOW", "20"))
+UPSTREAM_MIN_SAMPLES = int(os.getenv("UPSTREAM_MIN_SAMPLES", "5"))
+UPSTREAM_ERROR_RATE_THRESHOLD = float(os.getenv("UPSTREAM_ERROR_RATE_THRESHOLD", "0.5"))
+UPSTREAM_LATENCY_THRESHOLD_MS = float(os.getenv("UPSTREAM_LATENCY_THRESHOLD_MS", "20000"))
+UPSTREAM_DEGRADED_COOLDOWN_SECONDS = int(os.getenv("UPSTREAM_DEGRADED_COOLDOWN_SECONDS", "60"))
+# Recordings older than this are not served in auto mode; 0 disables the limit
+REPLAY_MAX_AGE_SECONDS = int(os.getenv("REPLAY_MAX_AGE_SECONDS", str(7 * 24 * 3600)))
+# Auto mode keeps at most this many recordings and drops those too old to be served; 0 disables the cap.
+# Explicit record mode keeps everything, since those recordings are captured for replay.
+UPSTREAM_MAX_RECORDINGS = int(os.getenv("UPSTREAM_MAX_RECORDINGS", "10000"))
+UPSTREAM_PURGE_EVERY = int(os.getenv("UPSTREAM_PURGE_EVERY", "100"))  # recordings written between purges
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+class UpstreamUnavailable(Exception):
+    pass
+
+
+def normalize_request(kind: str, request: dict) -> str:
+    """Canonical JSON for a request so equivalent calls share one recording."""
+    def normalize(value):
+        if isinstance(value, str):
+            value = _WHITESPACE.sub(" ", value).strip()
+            # Search queries are case-insensitive upstream
+            return value.lower() if kind == "search" else value
+        if isinstance(value, dict):
+            return {key: normalize(item) for key, item in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [normalize(item) for item in value]
+        return value
+
+    return json.dumps({"kind": kind, "request": normalize(request)}, sort_keys=True, ensure_ascii=False)
+
+
+class UpstreamGateway:
+    """Routes upstream calls through recording, replay and a degraded-mode breaker."""
+
+    def __init__(self, session_factory: Optional[Callable] = None, mode: str = UPSTREAM_MODE):
+        if mode not in UPSTREAM_MODES:
+            logger.warning("Unknown UPSTREAM_MODE %r, using 'auto'", mode)
+            mode = "auto"
+        self.session_factory = session_factory
+        self.mode = mode
+        self._outcomes = deque(maxlen=UPSTREAM_WINDOW)  # (ok, latency_ms)
+        self._degraded_until = 0.0
+        self._lock = threading.Lock()
+        self._stats = {
+            "live_calls": 0, "live_errors": 0, "recorded": 0, "replayed": 0, "replay_misses": 0, "purged": 0
+        }
+        # Recording id -> replays not yet written; serving a replay never takes the write lock
+        self._pending_replays = Counter()
+        self._recorded_since_purge = 0
+
+    def call(self, kind: str, request: dict, live: Callable[[], Any]) -> Any:
+        """Return the upstream response for request, live or replayed depending on mode and health."""
+        request_json = normalize_request(kind, request)
+        request_key = hashlib.sha256(request_json.encode("utf-8")).hexdigest()
+
+        if self.mode == "replay":
+            return self._replay_or_raise(request_key, max_age=None)
+
+        if self.mode == "auto" and self.is_degraded():
+            replayed = self._replay(request_key, max_age=REPLAY_MAX_AGE_SECONDS)
+            if replayed is not None:
+                return replayed
+
+        started = time.perf_counter()
+        try:
+            with span("upstream", kind):
+                response = live()
+        except Exception:
+            self._observe(False, (time.perf_counter() - started) * 1000)
+            if self.mode == "auto":
+                replayed = self._replay(request_key, max_age=REPLAY_MAX_AGE_SECONDS)
+                if replayed is not None:
+                    return replayed
+            raise
+        latency_ms = (time.perf_counter() - started) * 1000
+        self._observe(True, latency_ms)
+
+        if self.mode in ("record", "auto"):
+            self._record(kind, request_key, request_json, response, latency_ms)
+        return response
+
+    def is_degraded(self) -> bool:
+        with self._lock:
+            return time.monotonic() < self._degraded_until
+
+    def _observe(self, ok: bool, latency_ms: float):
+        with self._lock:
+            self._stats["live_calls"] += 1
+            if not ok:
+                self._stats["live_errors"] += 1
+            self._outcomes.append((ok, latency_ms))
+            if len(self._outcomes) < UPSTREAM_MIN_SAMPLES:
+                return
+            error_rate = sum(1 for outcome_ok, _ in self._outcomes if not outcome_ok) / len(self._outcomes)
+            latencies = sorted(latency for _, latency in self._outcomes)
+            median_latency = latencies[len(latencies) // 2]
+            if error_rate >= UPSTREAM_ERROR_RATE_THRESHOLD or median_latency >= UPSTREAM_LATENCY_THRESHOLD_MS:
+                if time.monotonic() >= self._degraded_until:
+                    logger.warning(
+                        "Upstream degraded (error rate %.2f, median latency %.0f ms); serving recordings for %ds",
+                        error_rate, median_latency, UPSTREAM_DEGRADED_COOLDOWN_SECONDS
+                    )
+                self._degraded_until = time.monotonic() + UPSTREAM_DEGRADED_COOLDOWN_SECONDS
+                # Start the next window fresh so recovery is judged on new calls only
+                self._outcomes.clear()
+
+    def _replay_or_raise(self, request_key: str, max_age: Optional[int]) -> Any:
+        replayed = self._replay(request_key, max_age)
+        if replayed is None:
+            raise UpstreamUnavailable("No recorded response for this request (replay mode)")
+        return replayed
+
+    def _replay(self, request_key: str, max_age: Optional[int]) -> Any:
+        if self.session_factory is None:
+            return None
+        from models import UpstreamRecording
+
+        db = self.session_factory()
+        try:
+            with span("replay", "lookup"):
+                recording = db.query(UpstreamRecording).filter(UpstreamRecording.request_key == request_key).first()
+            if recording and max_age:
+                oldest = datetime.now(timezone.utc) - timedelta(seconds=max_age)
+                recorded_at = recording.recorded_at
+                if recorded_at.tzinfo is None:
+                    recorded_at = recorded_at.replace(tzinfo=timezone.utc)
+                if recorded_at < oldest:
+                    recording = None
+            if recording is None:
+                with self._lock:
+                    self._stats["replay_misses"] += 1
+                return None
+            with self._lock:
+                self._stats["replayed"] += 1
+                self._pending_replays[recording.id] += 1
+            return json.loads(recording.response_json)
+        except Exception:
+            logger.warning("Replay lookup failed", exc_info=True)
+            return None
+        finally:
+            db.close()
+
+    def _record(self, kind: str, request_key: str, request_json: str, response: Any, latency_ms: float):
+        if self.session_factory is None:
+            return
+        from models import UpstreamRecording
+
+        db = self.session_factory()
+        try:
+            recording = db.query(UpstreamRecording).filter(UpstreamRecording.request_key == request_key).first()
+            if recording is None:
+                recording = UpstreamRecording(kind=kind, request_key=request_key, request_json=request_json)
+                db.add(recording)
+            recording.response_json = json.dumps(response, ensure_ascii=False)
+            recording.latency_ms = latency_ms
+            recording.recorded_at = datetime.now(timezone.utc)
+            with self._lock:
+                pending_replays, self._pending_replays = self._pending_replays, Counter()
+                self._recorded_since_purge += 1
+                purge = self.mode == "auto" and self._recorded_since_purge >= UPSTREAM_PURGE_EVERY
+                if purge:
+                    self._recorded_since_purge = 0
+            # Replay counts ride along with a write that happens anyway
+            for recording_id, count in pending_replays.items():
+                db.query(UpstreamRecording).filter(UpstreamRecording.id == recording_id).update(
+                    {UpstreamRecording.replay_count: func.coalesce(UpstreamRecording.replay_count, 0) + count},
+                    synchronize_session=False
+                )
+            purged = self._purge(db) if purge else 0
+            db.commit()
+            with self._lock:
+                self._stats["recorded"] += 1
+                self._stats["purged"] += purged
+        except Exception:
+            # Recording is best effort and must never fail the request
+            db.rollback()
+            logger.warning("Failed to record upstream response", exc_info=True)
+        finally:
+            db.close()
+
+    def _purge(self, db) -> int:
+        """Delete recordings auto mode would no longer serve, then the oldest beyond the cap."""
+        from models import UpstreamRecording
+
+        purged = 0
+        if REPLAY_MAX_AGE_SECONDS:
+            oldest = datetime.now(timezone.utc) - timedelta(seconds=REPLAY_MAX_AGE_SECONDS)
+            purged += db.query(UpstreamRecording).filter(
+                UpstreamRecording.recorded_at < oldest
+            ).delete(synchronize_session=False)
+        if UPSTREAM_MAX_RECORDINGS:
+            cutoff = db.query(UpstreamRecording.id).order_by(
+                UpstreamRecording.recorded_at.desc(), UpstreamRecording.id.desc()
+            ).offset(UPSTREAM_MAX_RECORDINGS).limit(1).scalar()
+            if cutoff is not None:
+                cutoff_recorded_at = db.query(UpstreamRecording.recorded_at).filter(
+                    UpstreamRecording.id == cutoff
+                ).scalar()
+                purged += db.query(UpstreamRecording).filter(
+                    (UpstreamRecording.recorded_at < cutoff_recorded_at)
+                    | ((UpstreamRecording.recorded_at == cutoff_recorded_at) & (UpstreamRecording.id <= cutoff))
+                ).delete(synchronize_session=False)
+        return purged
+
+    def status(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["replays_not_yet_saved"] = sum(self._pending_replays.values())
+            remaining = max(0.0, self._degraded_until - time.monotonic())
+        return {
+            "mode": self.mode,
+            "degraded": remaining > 0,
+            "degraded_seconds_remaining": round(remaining, 1),
+            "replay_max_age_seconds": REPLAY_MAX_AGE_SECONDS,
+            **stats
+        }